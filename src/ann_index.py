@@ -0,0 +1,238 @@
+from utils import similarity as si
+import numpy as np
+import logging
+import time
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Approximate nearest neighbour index (IVF) over medical concept embeddings.
+Concepts are clustered with spherical k-means; a query scans only the
+nprobe closest clusters and re-ranks their members with exact cosine
+similarity
+"""
+
+_arrays = ['centroids', 'offsets', 'ids', 'vectors']
+
+
+class ConceptIndex(object):
+    """
+    IVF index wrapping a KeyedVectors object. It exposes the subset of the
+    KeyedVectors interface used by the phenotype scripts (item lookup,
+    vocab, index2word, most_similar), so it can replace the embeddings in
+    _define_query_vector and disease_phenotype
+
+    @param nprobe: number of clusters scanned per query (higher values
+    trade latency for recall)
+    """
+
+    def __init__(self, kv, centroids, offsets, ids, vectors, nprobe=16):
+        self.kv = kv
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.nprobe = nprobe
+
+    @property
+    def vocab(self):
+        return self.kv.vocab
+
+    @property
+    def index2word(self):
+        return self.kv.index2word
+
+    @property
+    def vector_size(self):
+        return self.kv.vector_size
+
+    def __getitem__(self, w):
+        return self.kv[w]
+
+    def __contains__(self, w):
+        return w in self.kv.vocab
+
+    def init_sims(self):
+        self.kv.init_sims()
+
+    @property
+    def vectors_norm(self):
+        return si.unit_vectors(self.kv)
+
+    def most_similar(self, positive=None, topn=10, nprobe=None):
+        """
+        Approximate gensim most_similar (cosine similarity, the query
+        concepts are excluded from the results)
+        """
+        if isinstance(positive, basestring):
+            positive = [positive]
+        qidx = [self.kv.vocab[w].index for w in positive]
+        qv = np.mean([self.kv.word_vec(w, use_norm=True)
+                      for w in positive], axis=0)
+        qv /= np.linalg.norm(qv)
+        idx, sim = self.search(qv, topn + len(qidx), nprobe)
+        res = [(self.kv.index2word[i], float(s))
+               for i, s in zip(idx, sim) if i not in qidx]
+        return res[:topn]
+
+    def search(self, qv, topn=10, nprobe=None):
+        """
+        Return the (vocabulary indices, cosine similarities) of the topn
+        concepts closest to the unit vector qv
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        nprobe = min(nprobe, len(self.centroids))
+
+        # closest clusters
+        csim = np.dot(self.centroids, qv)
+        probe = np.argpartition(-csim, nprobe - 1)[:nprobe]
+
+        # re-rank the cluster members with exact similarity
+        cand = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1])
+                               for c in probe])
+        sim = np.dot(self.vectors[cand], qv)
+        topn = min(topn, len(cand))
+        if topn < len(cand):
+            top = np.argpartition(-sim, topn - 1)[:topn]
+        else:
+            top = np.arange(len(cand))
+        top = top[np.argsort(-sim[top], kind='mergesort')]
+        return (self.ids[cand[top]], sim[top])
+
+
+def build(kv, nlist=None, niter=10, sample=None, nprobe=16):
+    """
+    Build the IVF index of a KeyedVectors object
+
+    @param nlist: number of clusters (default: 4 * sqrt(vocabulary size))
+    @param sample: number of concepts used to train the clusters
+    (default: 256 per cluster)
+    """
+    unorm = si.unit_vectors(kv)
+    nvcb = unorm.shape[0]
+    if nlist is None:
+        nlist = int(4 * np.sqrt(nvcb))
+    nlist = max(1, min(nlist, nvcb))
+    if sample is None:
+        sample = 256 * nlist
+
+    # train the coarse quantizer
+    log.info('Training %d clusters on %d concepts' %
+             (nlist, min(sample, nvcb)))
+    rs = np.random.RandomState(0)
+    if sample < nvcb:
+        train = unorm[np.sort(rs.choice(nvcb, sample, replace=False))]
+    else:
+        train = unorm
+    centroids, _ = si.kmeans(train, nlist, niter=niter, spherical=True)
+
+    # inverted lists (concepts stored contiguously per cluster)
+    assign = si.assign_centroids(unorm, centroids, spherical=True)
+    ids = np.argsort(assign, kind='mergesort').astype(np.int32)
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=len(centroids)))
+    vectors = np.ascontiguousarray(unorm[ids], dtype=np.float32)
+
+    return ConceptIndex(kv, centroids, offsets, ids, vectors, nprobe=nprobe)
+
+
+def index_path(fout):
+    """
+    Prefix of the index files saved next to the embedding file
+    """
+    return '%s.ivf' % fout
+
+
+def save(index, fout):
+    """
+    Save the index next to the embedding file fout
+    """
+    try:
+        for a in _arrays:
+            np.save('%s-%s.npy' % (index_path(fout), a), getattr(index, a))
+    except Exception, e:
+        log.error('Impossible to save the index - %s ' % str(e))
+
+
+def load(fout, kv, nprobe=16, mmap=True):
+    """
+    Load the index saved next to the embedding file fout, memory-mapping
+    the arrays (read-only) when mmap is True
+    """
+    mode = 'r' if mmap else None
+    try:
+        arr = [np.load('%s-%s.npy' % (index_path(fout), a), mmap_mode=mode)
+               for a in _arrays]
+    except Exception, e:
+        log.error('Impossible to load the index - %s ' % str(e))
+        return
+    return ConceptIndex(kv, *arr, nprobe=nprobe)
+
+
+def recall_report(index, topn=100, nprobes=(1, 2, 4, 8, 16, 32, 64),
+                  nquery=500, outfile=None):
+    """
+    Compare the approximate neighbours against exact search on a sample
+    of concepts, reporting mean recall@topn and query latency for every
+    value of nprobe
+
+    @param outfile: optional csv file where the report is written
+    """
+    unorm = si.unit_vectors(index.kv)
+    rs = np.random.RandomState(0)
+    qidx = rs.choice(unorm.shape[0], min(nquery, unorm.shape[0]),
+                     replace=False)
+
+    # exact neighbours
+    exact = {}
+    start = time.time()
+    for bidx, top, _ in si.blocked_most_similar(unorm, qidx, topn=topn):
+        for i, q in enumerate(bidx):
+            exact[q] = set(top[i])
+    exact_ms = 1000 * (time.time() - start) / len(qidx)
+
+    report = []
+    log.info('nprobe\trecall@%d\tms/query (exact %.2f)' % (topn, exact_ms))
+    for nprobe in nprobes:
+        if nprobe > len(index.centroids):
+            break
+        rec = []
+        start = time.time()
+        for q in qidx:
+            idx, _ = index.search(unorm[q], topn + 1, nprobe)
+            idx = idx[idx != q][:topn]
+            rec.append(len(exact[q] & set(idx)) / float(max(len(exact[q]), 1)))
+        ms = 1000 * (time.time() - start) / len(qidx)
+        report.append({'nprobe': nprobe, 'recall': round(np.mean(rec), 4),
+                       'ms': round(ms, 3), 'exact_ms': round(exact_ms, 3)})
+        log.info('%d\t%.4f\t%.3f' % (nprobe, report[-1]['recall'], ms))
+
+    if outfile is not None:
+        with open(outfile, 'w') as f:
+            f.write('NPROBE,RECALL@%d,MS/QUERY,EXACT MS/QUERY\n' % topn)
+            for r in report:
+                f.write('%d,%.4f,%.3f,%.3f\n' %
+                        (r['nprobe'], r['recall'], r['ms'], r['exact_ms']))
+
+    return report
+
+
+"""
+Main script
+"""
+
+if __name__ == '__main__':
+    print ''
+
+    # load data (medical concept embeddings saved by ehr_embedding)
+    kv = None
+    fout = None
+
+    index = build(kv)
+    save(index, fout)
+    recall_report(index, outfile='%s-recall.csv' % index_path(fout))
+
+    print '\nTask completed\n'
@@ -0,0 +1,239 @@
+from multiprocessing.pool import ThreadPool
+import phenotype_evaluation as pe
+import BaseHTTPServer
+import numpy as np
+import threading
+import logging
+import json
+import time
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Local cohort retrieval service. The medical concept embeddings and the
+patient embedding store are loaded once and kept warm in memory; every
+request returns the top-K patients closest to a set of seed concepts
+(query expansion and mean/min aggregation as in
+phenotype_evaluation.eval_embedding).
+
+    POST /query  {"seeds": [...], "k": 100, "expand": true}
+                 or {"queries": [{"seeds": [...], "k": 100}, ...]} to
+                 score a batch of cohorts with one pass over the patients
+    GET  /stats  request count and latency percentiles
+"""
+
+
+class CohortIndex(object):
+    """
+    Warm patient embeddings ready to be queried
+
+    @param kv: medical concept embeddings (KeyedVectors or ConceptIndex)
+    @param store: patient embeddings (patient_store.PatientStore)
+    @param in_memory: load the sentence embeddings in memory instead of
+    reading them from the memory-mapped store
+    """
+
+    def __init__(self, kv, store, chunk_size=100000, in_memory=True):
+        self.kv = kv
+        self.kv.init_sims()
+        self.vectors = store.vectors
+        if in_memory:
+            self.vectors = np.asarray(store.vectors)
+        self.layout = pe._index_patients(store.pidx)
+        self.chunk_size = chunk_size
+        self.norms = pe._sentence_norms(self.vectors, chunk_size)
+        log.info('Loaded %d sentence embeddings of %d patients' %
+                 (self.layout[2][-1], len(self.layout[0])))
+
+    def query(self, queries, expand=True):
+        """
+        Return the top-K patients of every query
+
+        @param queries: list of {'seeds': [concepts], 'k': int}
+        @return: list of {'seeds', 'concepts', 'patients', 'distances'}
+        """
+        res = []
+        qmean = []
+        iq = []
+        for i, q in enumerate(queries):
+            query = pe._define_query_vector(self.kv, q['seeds'],
+                                            expand=expand)
+            res.append({'seeds': q['seeds'], 'concepts': [],
+                        'patients': [], 'distances': []})
+            if query is None:
+                continue
+            res[-1]['concepts'] = query[1]
+            qmean.append(pe._mean_query(query[0]))
+            iq.append(i)
+        if len(iq) == 0:
+            return res
+
+        # score all the queries with one pass over the patients
+        pdist, mrns = pe._score_patients(np.array(qmean), self.vectors,
+                                         self.norms, self.layout,
+                                         self.chunk_size)
+        for j, i in enumerate(iq):
+            top = _top_k(pdist[:, j], int(queries[i].get('k', 100)))
+            res[i]['patients'] = mrns[top].tolist()
+            res[i]['distances'] = pdist[top, j].round(6).tolist()
+        return res
+
+
+class LatencyStats(object):
+    """
+    Latency of the last requests (thread-safe)
+    """
+
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.ms = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, ms):
+        with self.lock:
+            self.count += 1
+            self.ms.append(ms)
+            if len(self.ms) > self.maxlen:
+                del self.ms[:len(self.ms) - self.maxlen]
+
+    def summary(self):
+        with self.lock:
+            ms = np.array(self.ms)
+            count = self.count
+        stats = {'requests': count}
+        if len(ms) > 0:
+            stats['mean_ms'] = round(float(ms.mean()), 3)
+            for p in [50, 95, 99]:
+                stats['p%d_ms' % p] = round(float(np.percentile(ms, p)), 3)
+        return stats
+
+
+class CohortServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server handling the requests on a pool of threads
+    """
+
+    def __init__(self, address, index, workers=4):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _CohortHandler)
+        self.index = index
+        self.stats = LatencyStats()
+        self.pool = ThreadPool(processes=max(1, workers))
+
+    def process_request(self, request, client_address):
+        self.pool.apply_async(self._process, (request, client_address))
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.close()
+        self.pool.join()
+
+
+def serve(kv, store, host='127.0.0.1', port=8080, workers=4,
+          chunk_size=100000, in_memory=True):
+    """
+    Load the embeddings and serve cohort queries until interrupted
+    """
+    index = CohortIndex(kv, store, chunk_size, in_memory)
+    server = CohortServer((host, port), index, workers)
+    log.info('Serving cohort queries on http://%s:%d' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+# private functions
+
+class _CohortHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._reply(200, self.server.stats.summary())
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/query':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        start = time.time()
+        try:
+            size = int(self.headers.getheader('content-length', 0))
+            req = json.loads(self.rfile.read(size))
+            queries = req.get('queries', [req])
+            for q in queries:
+                if isinstance(q.get('seeds'), basestring):
+                    q['seeds'] = [q['seeds']]
+                q['seeds'] = [s.encode('utf-8') if isinstance(s, unicode)
+                              else str(s) for s in q['seeds']]
+        except Exception, e:
+            self._reply(400, {'error': 'invalid request - %s' % str(e)})
+            return
+
+        try:
+            res = self.server.index.query(queries, req.get('expand', True))
+        except Exception, e:
+            log.error('Query failed - %s' % str(e))
+            self._reply(500, {'error': str(e)})
+            return
+        ms = 1000 * (time.time() - start)
+        self.server.stats.add(ms)
+        if 'queries' not in req:
+            res = res[0]
+        else:
+            res = {'queries': res}
+        res['ms'] = round(ms, 3)
+        self._reply(200, res)
+
+    def _reply(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def _top_k(dist, k):
+    """
+    Indices of the k smallest distances (sorted)
+    """
+    k = max(0, min(k, len(dist)))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    if k < len(dist):
+        top = np.argpartition(dist, k - 1)[:k]
+    else:
+        top = np.arange(len(dist))
+    return top[np.argsort(dist[top], kind='mergesort')]
+
+
+"""
+Main script
+"""
+
+if __name__ == '__main__':
+    print ''
+
+    # load data (medical concept embeddings and patient_store prefix)
+    kv = None
+    store = None
+
+    serve(kv, store)
+
+    print '\nTask completed\n'
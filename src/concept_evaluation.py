@@ -0,0 +1,255 @@
+from utils import similarity as si
+import numpy as np
+import logging
+import csv
+import os
+import re
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Evaluation of medical concept embeddings against a classification
+hierarchy (e.g., the multi-level Clinical Classification System). The
+ontology is parsed once into integer category arrays; the neighbours of
+all the ICD-9 concepts are computed with blocked matrix products and
+MAP / P@10 are computed on whole blocks of neighbours
+"""
+
+# parsed ontology files {(path, mtime): Ontology}
+_cache = {}
+
+
+class Ontology(object):
+    """
+    Concept categories at every level of the hierarchy
+
+    @param codes: concept codes (e.g., ICD-9 codes, dotted as in the
+    vocabulary or undotted as in the CCS files; see _code_key)
+    @param categories: {level: int32 category ID of every code, -1 for
+    empty or unclassified categories}
+    @param labels: {level: category of every category ID}
+    """
+
+    def __init__(self, codes, categories, labels):
+        self.codes = codes
+        self.categories = categories
+        self.labels = labels
+        self.index = dict((_code_key(c), i) for i, c in enumerate(codes))
+
+    @property
+    def levels(self):
+        return sorted(self.categories)
+
+
+def from_dict(evalemb):
+    """
+    Ontology from the dictionary {code: {level: category}}
+    """
+    codes = sorted(evalemb)
+    levels = set()
+    for c in codes:
+        levels.update(evalemb[c])
+    categories = {}
+    labels = {}
+    for lvl in levels:
+        categories[lvl], labels[lvl] = _intern_categories(
+            [evalemb[c].get(lvl, '') for c in codes])
+    return Ontology(codes, categories, labels)
+
+
+def load_ontology(evalfile, cache=True):
+    """
+    Load the ontology from a csv file with one code per row, the code in
+    the first column and one column per level named 'CCS LVL <n>' (or
+    'lvl<n>'), as the CCS multi-level tool. Quotes and blanks around the
+    values are removed; label columns ('CCS LVL <n> LABEL') are used to
+    detect unclassified categories
+
+    @param cache: reuse the ontology parsed before from the same file
+    """
+    key = (os.path.abspath(evalfile), os.path.getmtime(evalfile))
+    if cache and key in _cache:
+        return _cache[key]
+
+    with open(evalfile, 'rb') as f:
+        rd = csv.reader(f)
+        header = [_clean(h).upper() for h in next(rd)]
+        lcol = {}
+        tcol = {}
+        for i, h in enumerate(header):
+            m = re.match(r'^(?:CCS\s+)?LVL\s*(\d+)(\s+LABEL)?$', h)
+            if m is None:
+                continue
+            if m.group(2) is None:
+                lcol['lvl%s' % m.group(1)] = i
+            else:
+                tcol['lvl%s' % m.group(1)] = i
+
+        codes = []
+        values = dict((lvl, []) for lvl in lcol)
+        for r in rd:
+            if len(r) == 0:
+                continue
+            r = [_clean(v) for v in r]
+            codes.append(r[0])
+            for lvl, i in lcol.items():
+                v = r[i] if i < len(r) else ''
+                if lvl in tcol and tcol[lvl] < len(r) and \
+                        'unclassified' in r[tcol[lvl]].lower():
+                    v = ''
+                values[lvl].append(v)
+
+    categories = {}
+    labels = {}
+    for lvl in values:
+        categories[lvl], labels[lvl] = _intern_categories(values[lvl])
+    onto = Ontology(codes, categories, labels)
+    log.info('Loaded %d codes (%s) from %s' %
+             (len(codes), ', '.join('%s: %d categories' %
+                                    (lvl, len(labels[lvl]))
+                                    for lvl in onto.levels), evalfile))
+    if cache:
+        _cache[key] = onto
+    return onto
+
+
+def evaluate(emb, onto, level='lvl1', knn=50, block_size=1024):
+    """
+    Evaluate the medical concept embeddings: the knn closest concepts
+    (with a code in the ontology) of every classified ICD-9 concept are
+    ranked and the ones in the same category are relevant
+
+    @param emb: embeddings (gensim model or KeyedVectors)
+    @param onto: Ontology from load_ontology or from_dict
+    @return: {'MAP', 'P10', 'N'}
+    """
+    kv = getattr(emb, 'wv', emb)
+    ccat, query = _concept_categories(kv.index2word, onto, level)
+    qidx = np.flatnonzero(query)
+    if len(qidx) == 0:
+        log.error('No ICD-9 concept of the vocabulary is classified in the '
+                  'ontology (%d codes), check the code format' %
+                  len(onto.codes))
+        return {'MAP': np.nan, 'P10': np.nan, 'N': 0}
+    log.info('Category for the evaluation: %d' %
+             len(np.unique(ccat[qidx])))
+
+    unorm = si.unit_vectors(kv)
+    mpr = []
+    p10 = []
+    for bidx, top, _ in si.blocked_most_similar(unorm, qidx, topn=knn * 4,
+                                                block_size=block_size):
+        ap, pk = _rank_scores(ccat[bidx], ccat[top], knn, 10)
+        mpr.append(ap)
+        p10.append(pk)
+    mpr = np.concatenate(mpr) if len(mpr) > 0 else np.array([])
+    p10 = np.concatenate(p10) if len(p10) > 0 else np.array([])
+
+    maprec = round(np.mean(mpr), 3)
+    prec10 = round(np.mean(p10), 3)
+    log.info('Evaluation on %d ICD-9 codes' % len(p10))
+    log.info('Mean Average Precision = %.3f' % maprec)
+    log.info('Precision at 10 = %.3f' % prec10)
+
+    return {'MAP': maprec, 'P10': prec10, 'N': len(p10)}
+
+
+# private functions
+
+def _clean(v):
+    return v.strip().strip('\'"').strip()
+
+
+def _code_key(code):
+    """
+    Undotted, zero-padded form of an ICD-9 diagnosis code, so that the
+    codes of the vocabulary ('765.22', 'V01.1', 'E800.0') match the ones of
+    the CCS files ('76522', 'V011', 'E8000')
+    """
+    code = code.strip().upper()
+    head, dot, tail = code.partition('.')
+    if head.startswith('E'):
+        head = 'E' + head[1:].zfill(3)
+    elif head.startswith('V'):
+        head = 'V' + head[1:].zfill(2)
+    elif head.isdigit() and (dot or len(head) < 3):
+        head = head.zfill(3)
+    return head + tail
+
+
+def _intern_categories(values):
+    """
+    Category ID of every value (-1 for empty or unclassified categories)
+    """
+    ivcb = {}
+    cat = np.empty(len(values), dtype=np.int32)
+    for i, v in enumerate(values):
+        if len(v) == 0 or 'unclassified' in v:
+            cat[i] = -1
+        else:
+            cat[i] = ivcb.setdefault(v, len(ivcb))
+    labels = [v for v, _ in sorted(ivcb.items(), key=lambda x: x[1])]
+    return (cat, labels)
+
+
+def _concept_categories(index2word, onto, level):
+    """
+    Category of every concept of the vocabulary (concepts are
+    'type::label::code'; only the ICD-9 concepts are looked up, since the
+    codes of other types can collide with undotted ICD-9 codes)
+
+    @return: (category ID of every concept, -1 for empty or unclassified
+    categories and -2 for codes missing from the ontology or concepts of
+    other types; mask of the ICD-9 concepts to evaluate)
+    """
+    ocat = onto.categories[level]
+    ccat = np.empty(len(index2word), dtype=np.int32)
+    query = np.zeros(len(index2word), dtype=bool)
+    for i, v in enumerate(index2word):
+        tkn = v.split('::')
+        j = None
+        if len(tkn) >= 3 and tkn[0] == 'icd9':
+            j = onto.index.get(_code_key(tkn[2]))
+        if j is None:
+            ccat[i] = -2
+            continue
+        ccat[i] = ocat[j]
+        query[i] = ccat[i] >= 0
+    return (ccat, query)
+
+
+def _rank_scores(qcat, ncat, knn, k=10):
+    """
+    Average precision and precision at k of a block of queries, ranking
+    only the neighbours with a code in the ontology (first knn)
+
+    @param qcat: category of every query
+    @param ncat: category of the neighbours of every query (sorted)
+    """
+    valid = ncat > -2
+    pos = np.cumsum(valid, axis=1)
+    rel = valid & (pos <= knn) & (ncat == qcat[:, np.newaxis])
+    hits = np.cumsum(rel, axis=1)
+    nhit = hits[:, -1]
+    ap = np.where(rel, hits / np.maximum(pos, 1).astype(np.float64), 0.)
+    ap = ap.sum(axis=1) / np.maximum(nhit, 1)
+    pk = (rel & (pos <= k)).sum(axis=1) / float(k)
+    return (ap, pk)
+
+
+"""
+Main script
+"""
+
+if __name__ == '__main__':
+    print ''
+
+    # load data (medical concept embeddings and CCS file)
+    emb = None
+    evalfile = None
+
+    evaluate(emb, load_ontology(evalfile), level='lvl1', knn=50)
+
+    print '\nTask completed\n'
@@ -0,0 +1,184 @@
+import numpy as np
+import logging
+import os
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Compact export of medical concept embeddings. A store saved with prefix P
+holds:
+    P.vectors.npy  concept vectors (float32 or float16)
+    P.norms.npy    float32 L2 norm of every vector
+    P.unit.npy     float32 L2-normalized vectors (kept in float32 with
+                   float16 vectors, so the similarity products run in
+                   float32 on the mapped array)
+    P.vocab        concepts, one per line (line number = row)
+The arrays are memory-mapped read-only on load, so the processes loading
+the same store share one page-cached copy instead of unpickling the whole
+gensim model (training state included) each
+"""
+
+
+class ConceptVectors(object):
+    """
+    Read-only concept embeddings loaded from a compact store. It exposes
+    the KeyedVectors interface used by the phenotype scripts (item lookup,
+    vocab, index2word, most_similar, vectors_norm) and wv, so it can replace
+    a trained model as well
+
+    @param block_size: number of vectors scored per matrix product
+    """
+
+    def __init__(self, vectors, norms, index2word, block_size=65536,
+                 unit=None):
+        self.vectors = vectors
+        self.norms = norms
+        self.index2word = index2word
+        self.vocab = dict((w, _Entry(i)) for i, w in enumerate(index2word))
+        self.block_size = block_size
+        self._unit = unit
+
+    @property
+    def wv(self):
+        return self
+
+    @property
+    def vector_size(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return len(self.index2word)
+
+    def __contains__(self, w):
+        return w in self.vocab
+
+    def __getitem__(self, w):
+        return np.asarray(self.vectors[self.vocab[w].index], dtype=np.float32)
+
+    def word_vec(self, w, use_norm=False):
+        v = self[w]
+        if use_norm:
+            v = v / _safe(self.norms[self.vocab[w].index])
+        return v
+
+    def init_sims(self):
+        pass
+
+    @property
+    def vectors_norm(self):
+        """
+        L2-normalized vectors (memory-mapped from the store; computed on
+        first use, in a private float32 copy, for stores exported without
+        them)
+        """
+        if self._unit is None:
+            log.warning('No unit vectors in the store, normalizing a '
+                        'private copy (export the embeddings again to '
+                        'share them)')
+            unit = np.empty(self.vectors.shape, dtype=np.float32)
+            for b in xrange(0, len(unit), self.block_size):
+                e = b + self.block_size
+                unit[b:e] = self.vectors[b:e] / \
+                    _safe(self.norms[b:e])[:, np.newaxis]
+            self._unit = unit
+        return self._unit
+
+    def most_similar(self, positive=None, topn=10):
+        """
+        Cosine similarity ranking as gensim most_similar (the query
+        concepts are excluded from the results), computed on blocks of the
+        memory-mapped vectors
+        """
+        if isinstance(positive, basestring):
+            positive = [positive]
+        qidx = [self.vocab[w].index for w in positive]
+        qv = np.mean([self.word_vec(w, use_norm=True) for w in positive],
+                     axis=0)
+        qv /= _safe(np.linalg.norm(qv))
+
+        sim = np.empty(len(self.index2word), dtype=np.float32)
+        for b in xrange(0, len(sim), self.block_size):
+            e = b + self.block_size
+            sim[b:e] = np.dot(np.asarray(self.vectors[b:e],
+                                         dtype=np.float32), qv) / \
+                _safe(self.norms[b:e])
+        sim[qidx] = -np.inf
+
+        topn = min(topn, len(sim) - len(qidx))
+        if topn < 1:
+            return []
+        top = np.argpartition(-sim, topn - 1)[:topn]
+        top = top[np.argsort(-sim[top], kind='mergesort')]
+        return [(self.index2word[i], float(sim[i])) for i in top]
+
+
+def export_path(fout):
+    """
+    Prefix of the compact store saved next to the model file
+    """
+    return '%s.kv' % fout
+
+
+def export(kv, prefix, dtype=np.float32):
+    """
+    Save the vectors, norms and vocabulary of trained embeddings
+
+    @param kv: KeyedVectors (e.g., from word2vec.finalize)
+    @param dtype: precision of the saved vectors (float32 or float16)
+    """
+    vectors = np.asarray(kv.vectors, dtype=np.float32)
+    norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    np.save('%s.vectors.npy' % prefix, vectors.astype(dtype))
+    np.save('%s.norms.npy' % prefix, norms.astype(np.float32))
+    np.save('%s.unit.npy' % prefix, vectors / _safe(norms)[:, np.newaxis])
+    with open('%s.vocab' % prefix, 'wb') as f:
+        for w in kv.index2word:
+            if isinstance(w, unicode):
+                w = w.encode('utf-8')
+            f.write('%s\n' % w)
+    log.info('Exported %d concept vectors (%s) in %s' %
+             (len(norms), np.dtype(dtype).name, prefix))
+
+
+def load(prefix, mmap=True):
+    """
+    Load a compact store (memory-mapping the arrays read-only when mmap is
+    True)
+    """
+    mode = 'r' if mmap else None
+    try:
+        vectors = np.load('%s.vectors.npy' % prefix, mmap_mode=mode)
+        norms = np.load('%s.norms.npy' % prefix, mmap_mode=mode)
+        with open('%s.vocab' % prefix, 'rb') as f:
+            index2word = [w[:-1] for w in f]
+    except Exception, e:
+        log.error('Impossible to load the embeddings - %s ' % str(e))
+        return
+    unit = None
+    if os.path.isfile('%s.unit.npy' % prefix):
+        unit = np.load('%s.unit.npy' % prefix, mmap_mode=mode)
+        if unit.dtype != np.float32:
+            unit = None
+    return ConceptVectors(vectors, norms, index2word, unit=unit)
+
+
+# private functions
+
+class _Entry(object):
+    """
+    Vocabulary entry (row of the concept)
+    """
+
+    __slots__ = ['index']
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _safe(norms):
+    """
+    Norms with the zeros replaced by ones
+    """
+    return np.where(norms > 0, norms, 1).astype(np.float32)
@@ -1,4 +1,9 @@
+from utils import similarity as si
+from itertools import izip
+import ann_index
+import multiprocessing as mp
 import numpy as np
+import shutil
 import csv
 import os
 import warnings
@@ -7,12 +12,26 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
 
 
-def disease_phenotype(evcb, outdir):
+def disease_phenotype(evcb, outdir, block_size=1024, resume=False,
+                      checkpoint=500, workers=1):
     """
     Compute disease phenotypes (top 100 concepts) for all ICD-9 codes
-    in the vocabulary
+    in the vocabulary. Phenotypes are streamed to disk as soon as every
+    seed is processed and the output file is renamed into place at the end
 
-    @param evcb: pre-trained medical concept embeddings
+    @param evcb: pre-trained medical concept embeddings (or the approximate
+    nearest neighbour index from ann_index.load, which is always queried
+    one seed at a time in a single process)
+    @param block_size: number of ICD-9 seeds scored together against the
+    vocabulary with a single matrix product (None to query the embeddings
+    one seed at a time with most_similar)
+    @param resume: continue an interrupted run from its last checkpoint
+    @param checkpoint: number of seeds processed between checkpoints
+    @param workers: number of processes; with more than one process the
+    normalized embeddings are exported once to a read-only memory-mapped
+    file shared by all workers, which phenotype contiguous shards of the
+    sorted ICD-9 codes (set OMP_NUM_THREADS=1 to avoid oversubscribing
+    the cores with multi-threaded BLAS)
     """
 
     # create output directory
@@ -24,32 +43,29 @@ def disease_phenotype(evcb, outdir):
     # load ICD9 vocabulary
     icd_vcb = _define_icd_vocab(evcb.vocab)
     print 'Loaded %d unique ICD-9 codes' % len(icd_vcb)
+    codes = sorted(icd_vcb)
+
+    # the approximate index is only used by most_similar
+    if isinstance(evcb, ann_index.ConceptIndex):
+        block_size = None
+        workers = 1
 
     # phentoype using one ICD-9 code as seed query
-    phenotypes = []
     print 'Phenotype using every ICD-9 code as seed query'
-    for i, code in enumerate(sorted(icd_vcb)):
-        # log
-        if (i + 1) % 500 == 0:
-            print '-- processed %d codes' % (i + 1)
-
-        # create query
-        if not isinstance(icd_vcb[code], list):
-            seed = [icd_vcb[code]]
-        else:
-            seed = icd_vcb[code]
-        try:
-            qv, ql, phe = _define_query_vector(evcb, seed)
-        except Exception:
-            continue
-
-        # update phenotype list
-        phenotypes += phe
-
-    # save phenotypes
-    out = [['SEED', 'SIMILAR CONCEPTS', 'COSINE SIMILARITY']] + phenotypes
     outfile = '%s/icd9-phenotypes.csv' % outdir
-    _write_csv(outfile, out)
+    partfile = '%s.part' % outfile
+    ckptfile = '%s.ckpt' % outfile
+    if workers > 1:
+        _parallel_export(evcb, icd_vcb, codes, partfile,
+                         block_size or 1024, resume, workers)
+    else:
+        _stream_export(evcb, icd_vcb, codes, partfile, ckptfile,
+                       block_size, resume, checkpoint)
+
+    # move the complete file into place
+    os.rename(partfile, outfile)
+    if os.path.isfile(ckptfile):
+        os.remove(ckptfile)
 
     # save ICD-9 vocab
     outfile = '%s/icd9-vocab.csv' % outdir
@@ -61,6 +77,189 @@ def disease_phenotype(evcb, outdir):
 
 # private functions
 
+def _stream_export(evcb, icd_vcb, codes, partfile, ckptfile,
+                   block_size, resume, checkpoint):
+    """
+    Phenotype the ICD-9 codes in a single process, streaming the rows to
+    partfile with periodic checkpoints
+    """
+    # restart from the last checkpoint (rows written after it are dropped)
+    last = _read_checkpoint(ckptfile) if resume else None
+    if last is not None and os.path.isfile(partfile):
+        last_code, offset, ndone = last
+        codes = [c for c in codes if c > last_code]
+        print 'Resume after code %s (%d codes already processed)' \
+            % (last_code, ndone)
+        f = open(partfile, 'r+b')
+        f.truncate(offset)
+        f.seek(offset)
+    else:
+        ndone = 0
+        f = open(partfile, 'wb')
+        csv.writer(f).writerow(['SEED', 'SIMILAR CONCEPTS',
+                                'COSINE SIMILARITY'])
+
+    seeds = [icd_vcb[c] for c in codes]
+    if block_size is None:
+        phenotypes = _seed_phenotypes(evcb, seeds)
+    else:
+        phenotypes = _block_phenotypes(evcb, seeds, block_size)
+
+    # stream the phenotypes to disk
+    wr = csv.writer(f)
+    for i, (code, phe) in enumerate(izip(codes, phenotypes)):
+        wr.writerows(phe)
+        ndone += 1
+
+        # log and checkpoint
+        if ndone % checkpoint == 0 or i == len(codes) - 1:
+            _write_checkpoint(f, ckptfile, code, ndone)
+        if ndone % 500 == 0:
+            print '-- processed %d codes' % ndone
+    f.close()
+
+
+def _parallel_export(evcb, icd_vcb, codes, partfile, block_size, resume,
+                     workers):
+    """
+    Phenotype shards of the ICD-9 codes in a process pool sharing a
+    memory-mapped copy of the normalized embeddings. Every shard is written
+    to its own file (renamed into place when complete, so finished shards
+    are skipped on resume) and the shards are merged in code order
+    """
+    outdir = os.path.dirname(partfile)
+
+    # export the normalized embeddings once
+    vecfile = '%s.vectors.npy' % partfile
+    if not (resume and os.path.isfile(vecfile)):
+        np.save('%s.tmp.npy' % partfile, si.unit_vectors(evcb))
+        os.rename('%s.tmp.npy' % partfile, vecfile)
+
+    # contiguous shards of the sorted codes (several per worker to balance
+    # the load), aligned on the blocks of the single process export
+    nblock = (len(codes) + block_size - 1) // block_size
+    nshard = max(1, min(nblock, workers * 4))
+    bounds = np.linspace(0, nblock, nshard + 1).astype(int) * block_size
+    shards = ['%s-%05d-of-%05d' % (partfile, i, nshard)
+              for i in xrange(nshard)]
+    tasks = []
+    for i, fshard in enumerate(shards):
+        if resume and os.path.isfile(fshard):
+            continue
+        seeds = [icd_vcb[c] for c in codes[bounds[i]:bounds[i + 1]]]
+        qidx = [evcb.vocab[s].index for s in seeds]
+        tasks.append((fshard, seeds, qidx, block_size))
+    print '-- %d shards to process (%d skipped)' \
+        % (len(tasks), nshard - len(tasks))
+
+    pool = mp.Pool(processes=workers, initializer=_init_worker,
+                   initargs=(vecfile, evcb.index2word))
+    try:
+        for fshard in pool.imap_unordered(_phenotype_shard, tasks):
+            print '-- completed %s' % os.path.basename(fshard)
+    finally:
+        pool.close()
+        pool.join()
+
+    # merge the shards in deterministic order
+    with open(partfile, 'wb') as f:
+        csv.writer(f).writerow(['SEED', 'SIMILAR CONCEPTS',
+                                'COSINE SIMILARITY'])
+        for fshard in shards:
+            with open(fshard, 'rb') as fs:
+                shutil.copyfileobj(fs, f)
+    for fshard in shards:
+        os.remove(fshard)
+    os.remove(vecfile)
+    print '-- merged %d shards in %s' % (nshard, outdir)
+
+
+# shared state of the worker processes
+_worker = {}
+
+
+def _init_worker(vecfile, index2word):
+    _worker['unorm'] = np.load(vecfile, mmap_mode='r')
+    _worker['index2word'] = index2word
+
+
+def _phenotype_shard(task):
+    """
+    Phenotype one shard of seeds in a worker process
+    """
+    fshard, seeds, qidx, block_size = task
+    tmp = '%s.tmp' % fshard
+    with open(tmp, 'wb') as f:
+        wr = csv.writer(f)
+        for phe in _block_rows(_worker['unorm'], _worker['index2word'],
+                               seeds, qidx, block_size):
+            wr.writerows(phe)
+    os.rename(tmp, fshard)
+    return fshard
+
+
+def _seed_phenotypes(evcb, seeds, topn=100):
+    """
+    Phenotype every seed querying the embeddings one seed at a time
+    (generator of phenotype rows per seed)
+    """
+    for seed in seeds:
+        try:
+            msim = evcb.most_similar(positive=[seed], topn=topn)
+        except Exception:
+            msim = []
+        yield [[seed, m[0], m[1]] for m in msim]
+
+
+def _block_phenotypes(evcb, seeds, block_size, topn=100):
+    """
+    Phenotype every seed scoring blocks of seeds against the normalized
+    embedding matrix (generator of phenotype rows per seed)
+    """
+    unorm = si.unit_vectors(evcb)
+    qidx = [evcb.vocab[s].index for s in seeds]
+    return _block_rows(unorm, evcb.index2word, seeds, qidx, block_size, topn)
+
+
+def _block_rows(unorm, index2word, seeds, qidx, block_size, topn=100):
+    """
+    Generator of phenotype rows per seed from the normalized embeddings
+    """
+    nseed = 0
+    for bidx, top, tsim in si.blocked_most_similar(
+            unorm, qidx, topn=topn, block_size=block_size):
+        for i in xrange(len(bidx)):
+            seed = seeds[nseed]
+            nseed += 1
+            yield [[seed, index2word[j], float(tsim[i, k])]
+                   for k, j in enumerate(top[i])]
+
+
+def _write_checkpoint(f, ckptfile, code, ndone):
+    """
+    Flush the phenotypes written so far and record the last completed code
+    with the matching file offset
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    tmp = '%s.tmp' % ckptfile
+    with open(tmp, 'wb') as fc:
+        csv.writer(fc).writerow([code, f.tell(), ndone])
+    os.rename(tmp, ckptfile)
+
+
+def _read_checkpoint(ckptfile):
+    """
+    Read the last checkpoint as (code, file offset, processed codes)
+    """
+    try:
+        with open(ckptfile, 'rb') as f:
+            code, offset, ndone = next(csv.reader(f))
+        return (code, int(offset), int(ndone))
+    except Exception:
+        return
+
+
 def _define_query_vector(epheno, query_seed, expand=True):
     """
     Define the disease phenotype using distance analysis in the embedded space
@@ -0,0 +1,142 @@
+import numpy as np
+import logging
+import os
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+On-disk corpus of patient sentences. A corpus saved with prefix P holds:
+    P.txt      one sentence per line (gensim corpus_file format, blanks
+               inside concepts are escaped)
+    P.tokens   int32 concept IDs of all sentences (raw memmap)
+    P.offsets  int64 offset of every sentence in P.tokens (raw memmap)
+    P.vocab    concept strings, one per line (line number = concept ID)
+"""
+
+# concepts may contain blanks, which gensim uses as token separator
+_blank = ' '
+_escape = '\xe2\x96\x81'
+
+
+def write_corpus(sentences, prefix):
+    """
+    Stream the sentences to disk
+
+    @param sentences: iterable of sentences (lists of concepts)
+    @param prefix: path prefix of the corpus files
+    """
+    try:
+        os.makedirs(os.path.dirname(prefix))
+    except Exception:
+        pass
+
+    vocab = {}
+    nsent = 0
+    ntkn = 0
+    with open('%s.txt' % prefix, 'wb') as ftxt, \
+            open('%s.tokens' % prefix, 'wb') as ftkn, \
+            open('%s.offsets' % prefix, 'wb') as foff:
+        np.zeros(1, dtype=np.int64).tofile(foff)
+        for s in sentences:
+            ids = np.empty(len(s), dtype=np.int32)
+            for i, w in enumerate(s):
+                ids[i] = vocab.setdefault(w, len(vocab))
+            ids.tofile(ftkn)
+            ftxt.write(' '.join(escape(w) for w in s))
+            ftxt.write('\n')
+            nsent += 1
+            ntkn += len(s)
+            np.array([ntkn], dtype=np.int64).tofile(foff)
+
+    # concept strings sorted by ID
+    iv = sorted(vocab.items(), key=lambda x: x[1])
+    with open('%s.vocab' % prefix, 'wb') as f:
+        for w, _ in iv:
+            f.write('%s\n' % w)
+
+    log.info('Saved %d sentences (%d concepts, %d tokens) in %s' %
+             (nsent, len(vocab), ntkn, prefix))
+    return load_corpus(prefix)
+
+
+def load_corpus(prefix, mmap=True):
+    """
+    Load a corpus saved by write_corpus (memory-mapping the token arrays)
+    """
+    return TokenCorpus(prefix, mmap)
+
+
+class TokenCorpus(object):
+    """
+    Sentences stored as a flat int32 array of concept IDs with offsets.
+    Iterating the corpus yields the sentences as lists of concepts, so it
+    can be passed to every training algorithm as an iterable (it supports
+    multiple passes)
+    """
+
+    def __init__(self, prefix, mmap=True):
+        self.prefix = prefix
+        self.line_file = '%s.txt' % prefix
+        if mmap and os.path.getsize('%s.tokens' % prefix) > 0:
+            self.tokens = np.memmap('%s.tokens' % prefix,
+                                    dtype=np.int32, mode='r')
+            self.offsets = np.memmap('%s.offsets' % prefix,
+                                     dtype=np.int64, mode='r')
+        else:
+            self.tokens = np.fromfile('%s.tokens' % prefix, dtype=np.int32)
+            self.offsets = np.fromfile('%s.offsets' % prefix,
+                                       dtype=np.int64)
+        with open('%s.vocab' % prefix, 'rb') as f:
+            self.vocab = [w[:-1] for w in f]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def total_words(self):
+        return int(self.offsets[-1])
+
+    def sentence_ids(self, i):
+        """
+        Concept IDs of the i-th sentence
+        """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        vocab = self.vocab
+        chunk = 1000000
+        for b in xrange(0, len(self), chunk):
+            # read a chunk of sentences at once from the memmap
+            off = np.asarray(self.offsets[b:b + chunk + 1])
+            tkn = np.asarray(self.tokens[off[0]:off[-1]]).tolist()
+            off = (off - off[0]).tolist()
+            for i in xrange(len(off) - 1):
+                yield [vocab[t] for t in tkn[off[i]:off[i + 1]]]
+
+
+def escape(w):
+    return w.replace(_blank, _escape)
+
+
+def unescape(w):
+    return w.replace(_escape, _blank)
+
+
+def restore_vocab(kv):
+    """
+    Rename the concepts of a model trained in corpus_file mode back to the
+    original (unescaped) strings
+    """
+    words = []
+    for w in kv.index2word:
+        if isinstance(w, unicode):
+            w = w.encode('utf-8')
+        words.append(unescape(w))
+    kv.vocab = dict((words[i], kv.vocab[w])
+                    for i, w in enumerate(kv.index2word))
+    kv.index2word = words
+    if hasattr(kv, 'index2entity'):
+        kv.index2entity = words
+    return kv
@@ -0,0 +1,178 @@
+import numpy as np
+import logging
+import csv
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Columnar patient history store. The events of all patients are kept in
+CSR form: the events of the i-th patient are
+concepts[offsets[i]:offsets[i + 1]] (int32 IDs in the vocab interning
+table) and ages[offsets[i]:offsets[i + 1]] (age_in_days, int32 when all
+the ages are integral, float64 otherwise), sorted by age. A history
+saved with prefix P holds P.pids.npy, P.offsets.npy, P.concepts.npy,
+P.ages.npy and P.vocab (concept strings, one per line)
+"""
+
+_arrays = ['pids', 'offsets', 'concepts', 'ages']
+
+
+class PatientHistory(object):
+    """
+    Patient histories in CSR form with a shared concept interning table
+    """
+
+    def __init__(self, pids, offsets, concepts, ages, vocab):
+        self.pids = pids
+        self.offsets = offsets
+        self.concepts = concepts
+        self.ages = ages
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.pids)
+
+    def events(self, i):
+        """
+        Concept IDs and ages of the i-th patient
+        """
+        b = self.offsets[i]
+        e = self.offsets[i + 1]
+        return (self.concepts[b:e], self.ages[b:e])
+
+    def items(self):
+        """
+        Generate (pid, concept IDs, ages) for every patient
+        """
+        for i in xrange(len(self.pids)):
+            cid, ag = self.events(i)
+            yield (self.pids[i], cid, ag)
+
+    def to_dict(self):
+        """
+        Legacy dictionary <patient id: [(concept, age_in_days)]>
+        """
+        vocab = self.vocab
+        return dict((p, [(vocab[c], a) for c, a in zip(cid, ag)])
+                    for p, cid, ag in self.items())
+
+
+def from_dict(phist, vocab=None):
+    """
+    Convert the legacy dictionary <patient id: [(concept, age_in_days)]>
+    (events sorted by date)
+
+    @param vocab: interning table to extend (list of concept strings)
+    """
+    vocab = [] if vocab is None else list(vocab)
+    ivocab = dict((w, i) for i, w in enumerate(vocab))
+    pids = []
+    offsets = [0]
+    concepts = []
+    ages = []
+    for p, ev in phist.items():
+        pids.append(p)
+        for c, a in ev:
+            concepts.append(ivocab.setdefault(c, len(ivocab)))
+            ages.append(a)
+        offsets.append(len(concepts))
+    if len(ivocab) > len(vocab):
+        vocab += [w for w, _ in sorted(ivocab.items(), key=lambda x: x[1])
+                  [len(vocab):]]
+
+    # numpy would convert mixed numeric and string IDs to strings
+    nstr = sum(1 for p in pids if isinstance(p, basestring))
+    if 0 < nstr < len(pids):
+        raise ValueError('Patient IDs must be all strings or all numbers '
+                         '(%d of %d are strings)' % (nstr, len(pids)))
+    return PatientHistory(np.array(pids),
+                          np.array(offsets, dtype=np.int64),
+                          np.array(concepts, dtype=np.int32),
+                          _age_array(ages),
+                          vocab)
+
+
+def as_history(phist):
+    """
+    Return phist as a PatientHistory (adapting the legacy dictionary)
+    """
+    if isinstance(phist, PatientHistory):
+        return phist
+    return from_dict(phist)
+
+
+def load_csv(fname, pid_col=0, concept_col=1, age_col=2, header=True):
+    """
+    Load the patient events from a csv file with one event per row
+    (patient id, concept, age_in_days in any order)
+    """
+    ivocab = {}
+    ipids = {}
+    pid = []
+    concepts = []
+    ages = []
+    with open(fname, 'rb') as f:
+        rd = csv.reader(f)
+        if header:
+            next(rd)
+        for r in rd:
+            pid.append(ipids.setdefault(r[pid_col], len(ipids)))
+            concepts.append(ivocab.setdefault(r[concept_col], len(ivocab)))
+            ages.append(float(r[age_col]))
+    pid = np.array(pid, dtype=np.int64)
+    concepts = np.array(concepts, dtype=np.int32)
+    ages = _age_array(ages)
+
+    # group the events by patient sorting them by age (stable)
+    order = np.lexsort((ages, pid))
+    concepts = concepts[order]
+    ages = ages[order]
+    offsets = np.zeros(len(ipids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(pid, minlength=len(ipids)))
+
+    pids = np.array([p for p, _ in sorted(ipids.items(),
+                                          key=lambda x: x[1])])
+    vocab = [w for w, _ in sorted(ivocab.items(), key=lambda x: x[1])]
+    log.info('Loaded %d events of %d patients (%d concepts)' %
+             (len(ages), len(pids), len(vocab)))
+    return PatientHistory(pids, offsets, concepts, ages, vocab)
+
+
+def save(phist, prefix):
+    """
+    Save the history as .npy arrays and a vocabulary file
+    """
+    for a in _arrays:
+        np.save('%s.%s.npy' % (prefix, a), getattr(phist, a))
+    with open('%s.vocab' % prefix, 'wb') as f:
+        for w in phist.vocab:
+            f.write('%s\n' % w)
+
+
+def load(prefix, mmap=True):
+    """
+    Load a history saved by save, memory-mapping the arrays (read-only)
+    when mmap is True
+    """
+    mode = 'r' if mmap else None
+    arr = [np.load('%s.%s.npy' % (prefix, a), mmap_mode=mode)
+           for a in _arrays]
+    with open('%s.vocab' % prefix, 'rb') as f:
+        vocab = [w[:-1] for w in f]
+    return PatientHistory(*arr, vocab=vocab)
+
+
+# private functions
+
+def _age_array(ages):
+    """
+    Ages as int32 when they are all integral (the input values are kept
+    otherwise, so that fractional times are not truncated)
+    """
+    ages = np.asarray(ages)
+    if ages.dtype.kind in 'iub' or (ages.dtype.kind == 'f' and
+                                    np.all(np.floor(ages) == ages)):
+        return ages.astype(np.int32)
+    return ages
@@ -1,5 +1,5 @@
 from gensim.models import FastText
-import math
+import ehr_corpus
 import logging
 
 """
@@ -11,16 +11,27 @@ if not len(log.handlers):
     logging.basicConfig(format='%(message)s', level=logging.INFO)
 
 
-def train(sentences,
+def train(sentences=None,
           size=200,
           window=5,
           min_count=3,
           workers=10,
           sg=0,
           hs=1,
-          negative=5):
+          negative=5,
+          corpus_file=None):
+    """
+    Train the embeddings from an iterable of sentences or from the line
+    file of an on-disk corpus (corpus_file or a corpus loaded with
+    ehr_corpus passed as sentences), which gensim reads in parallel without
+    holding the corpus in memory
+    """
+    if isinstance(sentences, ehr_corpus.TokenCorpus):
+        corpus_file = sentences.line_file
+        sentences = None
 
     model = FastText(sentences=sentences,
+                     corpus_file=corpus_file,
                      size=size,
                      window=window,
                      min_count=min_count,
@@ -28,6 +39,8 @@ def train(sentences,
                      sg=sg,
                      hs=hs,
                      negative=negative)
+    if corpus_file is not None:
+        ehr_corpus.restore_vocab(model.wv)
 
     return model
 
@@ -53,9 +66,19 @@ def finalize(model):
     return dt
 
 
-def update(model, sentence, sg=0, hs=0, window=10):
-    model.workers = int(math.ceil(model.workers / 10))
-    model.window = window
-    model.sg = sg
-    model.hs = hs
-    return model.train(sentence, total_examples=len(sentence))
+def update(model, sentences, workers=None, epochs=None):
+    """
+    Continue training the model on new sentences, adding their new
+    concepts to the vocabulary (build_vocab with update=True). The training
+    parameters of the model (sg, hs, window, ...) are kept
+
+    @param workers: number of threads (default: the ones of the model)
+    @param epochs: number of epochs (default: the ones of the model)
+    """
+    if workers is not None:
+        model.workers = workers
+    if epochs is None:
+        epochs = model.epochs
+    model.build_vocab(sentences, update=True)
+    model.train(sentences, total_examples=model.corpus_count, epochs=epochs)
+    return model
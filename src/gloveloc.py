@@ -1,9 +1,17 @@
-from gensim.matutils import corpus2csc
-from gensim.corpora import Dictionary
+from multiprocessing.pool import ThreadPool
 from gensim.models import KeyedVectors
+import scipy.sparse as sp
 import numpy as np
+import ehr_corpus
 import logging
-import glove
+import array
+import time
+import os
+
+try:
+    import glove
+except ImportError:
+    glove = None
 
 log = logging.getLogger(__name__)
 if not len(log.handlers):
@@ -18,61 +26,230 @@ def train(sentences,
           size=200,
           window=5,
           min_count=3,
-          workers=5):
+          workers=5,
+          tmpdir=None,
+          backend='glove',
+          max_epochs=None,
+          tol=None,
+          max_time=None,
+          cooccur=None):
+    """
+    Train GloVe embeddings on the sentence-level co-occurrences
 
-    # filter the vocabulary
-    vcb = {}
-    for s in sentences:
-        for w in s:
-            vcb.setdefault(w, 0)
-            vcb[w] += 1
-    vocab = set(w for w in vcb if vcb[w] >= min_count)
-
-    # pre-process the sentences
-    corpus = []
-    for s in sentences:
-        c = vocab & set(s)
-        if len(c) > 1:
-            corpus.append(list(c))
-
-    # create the BoW matrix
-    dct = Dictionary(corpus)
-    bow = [dct.doc2bow(el) for el in corpus]
-    td_mtx = corpus2csc(bow)
-
-    # vocabulary indices
-    ivcb = dct.token2id
-    iivcb = {v: k for k, v in ivcb.items()}
+    @param tmpdir: directory where the intermediate data of the
+    co-occurrence builder are spilled (None to keep them in memory)
+    @param backend: 'glove' (third-party glove package, trained until the
+    error drops below 0.1) or 'native' (vectorized AdaGrad on the sparse
+    co-occurrences, see fit)
+    @param max_epochs: maximum number of epochs (default: unbounded for
+    glove, 100 for native)
+    @param tol: stop when the relative error improvement of an epoch is
+    below tol (default: not used for glove, 1e-3 for native)
+    @param max_time: stop after max_time seconds of training
+    @param cooccur: precomputed (concepts, co-occurrence matrix) from
+    cooccurrence or load_cooccurrence (sentences are then ignored)
+    """
 
     # create the co-occurrence matrix
-    tt_mtx = np.dot(td_mtx, td_mtx.T)
-
-    # create the co-occurrence dictionary
-    co = dict(tt_mtx.todok())
-    co_occur = {}
-    for c in co:
-        co_occur.setdefault(c[0], {})
-        co_occur[c[0]][c[1]] = co[c]
+    if cooccur is None:
+        words, tt_mtx = cooccurrence(sentences, min_count=min_count,
+                                     tmpdir=tmpdir)
+    else:
+        words, tt_mtx = cooccur
 
     # train Glove embeddings
-    model = glove.Glove(co_occur, d=size, alpha=0.1, x_max=5000)
-    epoch = 0
-    while True:
-        epoch += 1
-        err = model.train(step_size=0.1, workers=workers,
-                          batch_size=128, verbose=False)
-        print "Epoch %d: error = %.3f" % (epoch, err)
-        if err < 0.1:
-            break
+    if backend == 'native':
+        weights = fit(tt_mtx, size=size, workers=workers,
+                      max_epochs=max_epochs or 100,
+                      tol=1e-3 if tol is None else tol, max_time=max_time)
+    else:
+        weights = _train_glove_package(tt_mtx, size, workers,
+                                       max_epochs, tol, max_time)
 
     # create vector objects
     kv = KeyedVectors(size)
-    words = [iivcb[i] for i in xrange(len(model.W))]
-    kv.add(entities=words, weights=model.W)
+    kv.add(entities=words, weights=weights)
 
     return kv
 
 
+def fit(tt_mtx,
+        size=200,
+        alpha=0.75,
+        x_max=100,
+        step_size=0.1,
+        batch_size=4096,
+        workers=5,
+        max_epochs=100,
+        tol=1e-3,
+        max_time=None,
+        seed=0):
+    """
+    Fit GloVe word vectors on a sparse co-occurrence matrix with mini-batch
+    AdaGrad. Every epoch shuffles the non-zero entries and splits them in
+    one shard per worker thread; the threads update the shared parameters
+    without locking (Hogwild), one vectorized mini-batch at a time
+
+    @param alpha, x_max: parameters of the weighting function
+    f(x) = min(1, (x / x_max) ^ alpha)
+    @return: word vectors (float32)
+    """
+    rs = np.random.RandomState(seed)
+    co = tt_mtx.tocoo()
+    irow = co.row.astype(np.int32)
+    icol = co.col.astype(np.int32)
+    logx = np.log(co.data.astype(np.float32))
+    fx = np.minimum(1, (co.data / float(x_max)) ** alpha).astype(np.float32)
+    nvcb = tt_mtx.shape[0]
+
+    # parameters and AdaGrad accumulators
+    prm = {'W': (rs.rand(nvcb, size).astype(np.float32) - 0.5) / size,
+           'C': (rs.rand(nvcb, size).astype(np.float32) - 0.5) / size,
+           'bw': np.zeros(nvcb, dtype=np.float32),
+           'bc': np.zeros(nvcb, dtype=np.float32)}
+    gsq = dict((k, np.ones_like(v)) for k, v in prm.items())
+
+    def run_shard(nz):
+        err = 0.0
+        for b in xrange(0, len(nz), batch_size):
+            k = nz[b:b + batch_size]
+            i = irow[k]
+            j = icol[k]
+            wi = prm['W'][i]
+            cj = prm['C'][j]
+            diff = (np.einsum('ij,ij->i', wi, cj) + prm['bw'][i] +
+                    prm['bc'][j] - logx[k])
+            g = fx[k] * diff
+            err += 0.5 * np.dot(g, diff)
+            _adagrad(prm['W'], gsq['W'], i, g[:, np.newaxis] * cj, step_size)
+            _adagrad(prm['C'], gsq['C'], j, g[:, np.newaxis] * wi, step_size)
+            _adagrad(prm['bw'], gsq['bw'], i, g, step_size)
+            _adagrad(prm['bc'], gsq['bc'], j, g, step_size)
+        return err
+
+    pool = ThreadPool(processes=max(1, workers))
+    start = time.time()
+    last = None
+    try:
+        for epoch in xrange(1, max_epochs + 1):
+            t = time.time()
+            shards = np.array_split(rs.permutation(len(logx)), workers)
+            err = sum(pool.map(run_shard, shards)) / max(len(logx), 1)
+            log.info('Epoch %d: error = %.5f (%.1fs)' %
+                     (epoch, err, time.time() - t))
+
+            # stopping criteria
+            if last is not None and last > 0 and (last - err) / last < tol:
+                log.info('Converged: relative improvement below %g' % tol)
+                break
+            if max_time is not None and time.time() - start > max_time:
+                log.info('Stopped: time limit of %ds reached' % max_time)
+                break
+            last = err
+    finally:
+        pool.close()
+        pool.join()
+
+    return prm['W']
+
+
+def cooccurrence(sentences, min_count=3, chunk_size=100000, tmpdir=None):
+    """
+    Build the sparse co-occurrence matrix of the concepts appearing at least
+    min_count times (two concepts co-occur when they are in the same
+    sentence; sentences with less than two such concepts are skipped)
+
+    The sentences are read once and interned into a flat int32 token array
+    (an on-disk corpus from ehr_corpus is used as is); the counts are then
+    accumulated in chunks of sentences as sparse matrices
+
+    @param chunk_size: number of sentences per chunk
+    @param tmpdir: directory where the tokens and the partial counts are
+    spilled, merged at the end (None to keep them in memory)
+    @return: (concepts, int32 CSR co-occurrence matrix)
+    """
+    if isinstance(sentences, ehr_corpus.TokenCorpus):
+        corpus = sentences
+    elif tmpdir is not None:
+        corpus = ehr_corpus.write_corpus(
+            sentences, os.path.join(tmpdir, 'glove-corpus'))
+    else:
+        corpus = _intern_sentences(sentences)
+    tokens = corpus.tokens
+    offsets = corpus.offsets
+
+    # filter the vocabulary
+    vcnt = np.zeros(len(corpus.vocab), dtype=np.int64)
+    for b in xrange(0, len(tokens), 10 * chunk_size):
+        vcnt += np.bincount(tokens[b:b + 10 * chunk_size],
+                            minlength=len(vcnt))
+    keep = np.flatnonzero(vcnt >= min_count)
+    newid = np.empty(len(vcnt), dtype=np.int32)
+    newid.fill(-1)
+    newid[keep] = np.arange(len(keep))
+    nvcb = len(keep)
+
+    # accumulate the co-occurrences chunk by chunk
+    tt_mtx = sp.csr_matrix((nvcb, nvcb), dtype=np.int32)
+    parts = []
+    nsent = len(offsets) - 1
+    for b in xrange(0, nsent, chunk_size):
+        off = np.asarray(offsets[b:b + chunk_size + 1])
+        tkn = newid[np.asarray(tokens[off[0]:off[-1]])]
+        row = np.repeat(np.arange(len(off) - 1), np.diff(off))
+        row = row[tkn >= 0]
+        tkn = tkn[tkn >= 0]
+
+        # BoW matrix (binary, at least two concepts per sentence)
+        td_mtx = sp.csr_matrix(
+            (np.ones(len(tkn), dtype=np.int32), (row, tkn)),
+            shape=(len(off) - 1, nvcb))
+        td_mtx.sum_duplicates()
+        td_mtx.data.fill(1)
+        td_mtx = td_mtx[np.diff(td_mtx.indptr) > 1]
+
+        co = (td_mtx.T * td_mtx).tocsr()
+        if tmpdir is None:
+            tt_mtx = tt_mtx + co
+        else:
+            parts.append(os.path.join(tmpdir, 'glove-cooccur-%05d.npz' %
+                                      len(parts)))
+            sp.save_npz(parts[-1], co)
+    if tmpdir is not None:
+        tt_mtx = _merge_parts(parts, tt_mtx)
+        if corpus is not sentences:
+            for ext in ['txt', 'tokens', 'offsets', 'vocab']:
+                os.remove('%s.%s' % (corpus.prefix, ext))
+
+    # drop concepts without co-occurrences
+    used = np.flatnonzero(np.diff(tt_mtx.indptr) > 0)
+    tt_mtx = tt_mtx[used][:, used].tocsr()
+    words = [corpus.vocab[i] for i in keep[used]]
+    log.info('Co-occurrence matrix: %d concepts, %d non-zero entries' %
+             (len(words), tt_mtx.nnz))
+
+    return (words, tt_mtx)
+
+
+def save_cooccurrence(words, tt_mtx, prefix):
+    """
+    Save a co-occurrence matrix (P.npz) and its concepts (P.vocab)
+    """
+    sp.save_npz('%s.npz' % prefix, tt_mtx)
+    with open('%s.vocab' % prefix, 'wb') as f:
+        for w in words:
+            f.write('%s\n' % w)
+
+
+def load_cooccurrence(prefix):
+    """
+    Load a co-occurrence matrix saved by save_cooccurrence
+    """
+    with open('%s.vocab' % prefix, 'rb') as f:
+        words = [w[:-1] for w in f]
+    return (words, sp.load_npz('%s.npz' % prefix).tocsr())
+
+
 def save(model, fout):
     try:
         model.save(fout)
@@ -86,3 +263,114 @@ def load(fout):
     except Exception, e:
         log.error('Impossible to load the model - %s ' % str(e))
         return
+
+
+def finalize(model):
+    return model
+
+
+# private functions
+
+class _MemoryCorpus(object):
+    """
+    Interned sentences held in memory (same arrays as ehr_corpus)
+    """
+
+    def __init__(self, vocab, tokens, offsets):
+        self.vocab = vocab
+        self.tokens = tokens
+        self.offsets = offsets
+
+
+def _intern_sentences(sentences):
+    """
+    Intern the sentences into a flat int32 token array with offsets
+    """
+    ivcb = {}
+    tokens = array.array('i')
+    offsets = array.array('l', [0])
+    for s in sentences:
+        tokens.extend(ivcb.setdefault(w, len(ivcb)) for w in s)
+        offsets.append(len(tokens))
+    vocab = [w for w, _ in sorted(ivcb.items(), key=lambda x: x[1])]
+    return _MemoryCorpus(vocab,
+                         np.frombuffer(tokens, dtype=np.int32),
+                         np.frombuffer(offsets, dtype=np.int64))
+
+
+def _merge_parts(parts, tt_mtx):
+    """
+    Merge the partial co-occurrence matrices saved on disk pairwise
+    """
+    while len(parts) > 1:
+        merged = []
+        for i in xrange(0, len(parts) - 1, 2):
+            co = sp.load_npz(parts[i]) + sp.load_npz(parts[i + 1])
+            sp.save_npz(parts[i], co)
+            os.remove(parts[i + 1])
+            merged.append(parts[i])
+        if len(parts) % 2 == 1:
+            merged.append(parts[-1])
+        parts = merged
+    if len(parts) == 1:
+        tt_mtx = tt_mtx + sp.load_npz(parts[0])
+        os.remove(parts[0])
+    return tt_mtx.tocsr()
+
+
+def _adagrad(prm, gsq, idx, grad, step_size):
+    """
+    AdaGrad update of the parameter rows idx, summing the gradients of
+    repeated rows first
+    """
+    order = np.argsort(idx, kind='mergesort')
+    sidx = idx[order]
+    starts = np.flatnonzero(np.r_[True, sidx[1:] != sidx[:-1]])
+    uidx = sidx[starts]
+    grad = np.add.reduceat(grad[order], starts, axis=0)
+    gsq[uidx] += grad ** 2
+    prm[uidx] -= step_size * grad / np.sqrt(gsq[uidx])
+
+
+def _train_glove_package(tt_mtx, size, workers, max_epochs, tol, max_time):
+    """
+    Train the embeddings with the third-party glove package
+    """
+    if glove is None:
+        raise ImportError('the glove package is not installed')
+    co_occur = _cooccurrence_dict(tt_mtx)
+    model = glove.Glove(co_occur, d=size, alpha=0.1, x_max=5000)
+    start = time.time()
+    last = None
+    epoch = 0
+    while max_epochs is None or epoch < max_epochs:
+        epoch += 1
+        t = time.time()
+        err = model.train(step_size=0.1, workers=workers,
+                          batch_size=128, verbose=False)
+        print "Epoch %d: error = %.3f (%.1fs)" % (epoch, err, time.time() - t)
+        if err < 0.1:
+            break
+        if tol is not None and last is not None and last > 0 and \
+                (last - err) / last < tol:
+            break
+        if max_time is not None and time.time() - start > max_time:
+            break
+        last = err
+    return model.W
+
+
+def _cooccurrence_dict(tt_mtx):
+    """
+    Convert the CSR co-occurrence matrix into the dictionary of
+    dictionaries expected by the glove package
+    """
+    co_occur = {}
+    indptr = tt_mtx.indptr
+    indices = tt_mtx.indices.tolist()
+    data = tt_mtx.data.astype(np.float64).tolist()
+    for i in xrange(tt_mtx.shape[0]):
+        b = indptr[i]
+        e = indptr[i + 1]
+        co_occur[i] = dict(zip(indices[b:e], data[b:e]))
+    return co_occur
@@ -1,9 +1,14 @@
 import word2vec
 import fasttext
 import gloveloc
+import ann_index
+import concept_evaluation
+import concept_store
+import ehr_corpus
+import ehr_history
+from utils import windows
 import numpy as np
 import logging
-import bisect
 import os
 import random
 import warnings
@@ -22,19 +27,31 @@ def ehr_embedding(phist,
                   outdir=None,
                   emb_size=200,
                   workers=20,
-                  algo='word2vec'
+                  algo='word2vec',
+                  ann=False,
+                  corpus=None,
+                  incremental=False,
+                  export=None
                   ):
     """
     Run word embedding on sequential EHRS
 
     @param phist: dictionary with <patient id: [clinical events sorted by date]
+    or the equivalent ehr_history.PatientHistory
     @param vocab: dictionary mapping concept IDs to label
+    @param ann: build the approximate nearest neighbour index of the
+    concepts next to the saved embeddings (see ann_index)
+    @param corpus: path prefix of an on-disk corpus (see ehr_corpus); the
+    sentences are streamed there instead of being kept in memory and the
+    models are trained from disk
+    @param incremental: continue training the last snapshot saved in
+    outdir on the sentences with events added since then (word2vec and
+    fasttext only); every run saves a new versioned snapshot
+    @param export: dtype (np.float32 or np.float16) of the compact export
+    of the vectors saved next to the model for fast loading (see
+    concept_store), None to skip it
     """
 
-    # create the sentences
-    ehr_sentences = _create_sentences(
-        phist, window_length, window_step)
-
     # choose model
     log.info('Embedding algorithm: %s' % algo)
     if algo == 'fasttext':
@@ -44,14 +61,8 @@ def ehr_embedding(phist,
     else:
         model = word2vec
 
-    # train
-    phemb = model.train(sentences=ehr_sentences,
-                        size=emb_size,
-                        window=5,
-                        min_count=3,
-                        workers=workers)
-
-    # save the model
+    # output file
+    fout = None
     if outdir is not None:
         try:
             os.mkdir(outdir)
@@ -59,7 +70,73 @@ def ehr_embedding(phist,
             pass
         fout = os.path.join(
             outdir, '%s-pheno-embedding-%d.emb' % (algo, emb_size))
-        model.save(phemb, fout)
+
+    # last snapshot
+    snapshot = None
+    if incremental:
+        if algo == 'glove':
+            log.warning('GloVe does not support incremental training, '
+                        'training from scratch')
+            incremental = False
+        elif fout is None:
+            log.warning('Incremental training requires outdir, '
+                        'training from scratch')
+            incremental = False
+        else:
+            phist = ehr_history.as_history(phist)
+            snapshot = _load_snapshot(fout, window_length, window_step)
+    if snapshot is not None:
+        phemb = model.load(_snapshot_file(fout, snapshot['version']))
+        if phemb is None:
+            log.warning('Snapshot %d could not be loaded, training from '
+                        'scratch' % snapshot['version'])
+            snapshot = None
+
+    # create the sentences (only the new ones when updating a snapshot)
+    since = None
+    if snapshot is not None:
+        since = _events_since(phist, snapshot)
+    if corpus is None:
+        ehr_sentences = _create_sentences(
+            phist, window_length, window_step, since)
+    else:
+        log.info('Creating sentences from the EHRs')
+        ehr_sentences = ehr_corpus.write_corpus(
+            _iter_sentences(phist, window_length, window_step, since),
+            corpus)
+
+    # train
+    if snapshot is None:
+        phemb = model.train(sentences=ehr_sentences,
+                            size=emb_size,
+                            window=5,
+                            min_count=3,
+                            workers=workers)
+        version = 0
+    else:
+        version = snapshot['version']
+        if len(ehr_sentences) > 0:
+            log.info('Updating snapshot %d' % version)
+            model.update(phemb, ehr_sentences, workers=workers)
+            version += 1
+        else:
+            log.info('Snapshot %d is up to date' % version)
+
+    # save the model
+    if fout is not None and (snapshot is None or
+                             version > snapshot['version']):
+        fsave = _snapshot_file(fout, version)
+        model.save(phemb, fsave)
+        if incremental:
+            _save_snapshot(fout, phist, version, window_length, window_step)
+
+        if ann:
+            kv = getattr(phemb, 'wv', phemb)
+            ann_index.save(ann_index.build(kv), fsave)
+
+        if export is not None:
+            concept_store.export(model.finalize(phemb),
+                                 concept_store.export_path(fsave), export)
 
     if evalfile is not None:
         ehr_evaluation(phemb=phemb, evalfile=evalfile, knn=knn)
@@ -67,56 +144,68 @@ def ehr_embedding(phist,
     return phemb
 
 
-def ehr_evaluation(emb=None, gtfile=None, evalemb=None,
-                   evalfile=None, knn=50):
+def ehr_evaluation(phemb=None, evalfile=None, evalemb=None, knn=50,
+                   level='lvl1'):
     """
     Evaluate medical concept embeddings using ICD code hierarchies from
     the clinical classification system
 
     @param evalfile: file with the medical concept ontology used for
-    evaluation (e.g., Clinical Classification System, SNOMED)
+    evaluation (e.g., Clinical Classification System, SNOMED), see
+    concept_evaluation.load_ontology
+    @param evalemb: ontology already loaded as {ICD: {level: category}}
     """
 
-    # load data from evalfile as {ICD: <ICD in the same ontology group>}
-    evalemb = {}
+    # load data from evalfile (parsed once and cached)
+    if evalemb is None:
+        onto = concept_evaluation.load_ontology(evalfile)
+    else:
+        onto = concept_evaluation.from_dict(evalemb)
 
-    return _evaluation(emb, evalemb, knn)
+    return concept_evaluation.evaluate(phemb, onto, level=level, knn=knn)
 
 
 # private functions
 
-def _create_sentences(phist, w_length, w_step):
+def _create_sentences(phist, w_length, w_step, since=None):
     """
     Create patient longitudinal sentences. We used age_in_days as temporal
     index (replace with dates or other surrogates for time information)
     """
     log.info('Creating sentences from the EHRs')
-    sentences = []
-    for p, ev in phist.items():
-        concepts = [el[0] for el in ev]
-        age_in_days = [el[1] for el in ev]
+    sentences = list(_iter_sentences(phist, w_length, w_step, since))
+    log.info('Created %d sentences' % len(sentences))
+    return sentences
+
+
+def _iter_sentences(phist, w_length, w_step, since=None):
+    """
+    Generate the patient longitudinal sentences one at a time
+
+    @param since: number of events of every patient already used (only the
+    sentences of the windows with later events are generated)
+    """
+    phist = ehr_history.as_history(phist)
+    vocab = phist.vocab
+    if since is None:
+        patients = xrange(len(phist))
+    else:
+        patients = np.flatnonzero(np.diff(phist.offsets) > since)
+    for i in patients:
+        cid, ages = phist.events(i)
+        concepts = cid.tolist()
+        age_in_days = ages.tolist()
+        first = 0 if since is None else since[i]
         last_ag = []
         last_co = []
 
         # create the sentences moving the time window
-        begin = age_in_days[0]
-        while begin <= age_in_days[-1]:
-            # find the range in age_in_days
-            end = begin + w_length
-            il = bisect.bisect_left(age_in_days, begin)
-            ir = bisect.bisect_left(age_in_days, end)
-
+        for il, ir in windows.sliding_windows(age_in_days, w_length, w_step):
             # get data
             ag = age_in_days[il:ir]
             co = concepts[il:ir]
 
-            # move window
-            begin += w_step
-
             # check interval
-            if len(ag) == 0:
-                continue
-
             if ag == last_ag:
                 continue
 
@@ -130,92 +219,79 @@ def _create_sentences(phist, w_length, w_step):
             last_ag = ag
             last_co = co
 
+            # window already used
+            if ir <= first:
+                continue
+
             # create sentence
-            s = list(set(co))
+            s = [vocab[c] for c in set(co)]
             random.shuffle(s)
-            sentences.append(s)
+            yield s
 
-    log.info('Created %d sentences' % len(sentences))
-    return sentences
 
-
-def _evaluation(phemb, evalemb, level='lvl1', knn=50):
+def _snapshot_file(fout, version):
     """
-    Medical concept embeddings based on Clinical Classification System
-    and hierarchy level equalt to 1
+    Model file of a snapshot (version 0 is the model trained from scratch)
     """
-    gt_categ = {}
-    for v, it in evalemb.items():
-        if 'unclassified' in it[level] or len(it[level]) == 0:
-            continue
-        gt_categ.setdefault(it[level], set()).add(v)
-
-    print log.info('Category for the evaluation: %d' % len(gt_categ))
-
-    topn = knn * 4
-    mpr = []
-    p10 = []
-    for v in phemb.wv.vocab:
-        tkn = v.split('::')
-        if tkn[0] != 'icd9':
-            continue
-
-        if len(tkn) < 3:
-            continue
-
-        if tkn[2] not in evalemb:
-            continue
-
-        ctg = evalemb[tkn[2]][level]
-        if ctg not in gt_categ:
-            continue
-
-        phenosim = phemb.most_similar(positive=[v], topn=topn)
-        rank = []
-        for c in phenosim:
-            try:
-                ph = c[0].split('::')[2]
-            except Exception:
-                continue
-            if ph in evalemb:
-                rank.append(evalemb[ph][level])
-        rank = rank[:knn]
-        mpr.append(_maprec(rank, ctg))
-        p10.append(_prec_at_k(rank, ctg, 10))
+    if version == 0:
+        return fout
+    return '%s.v%03d.emb' % (os.path.splitext(fout)[0], version)
 
-    maprec = round(np.mean(mpr), 3)
-    prec10 = round(np.mean(p10), 3)
-    log.info('Evaluation on %d ICD-9 codes' % len(p10))
-    log.info('Mean Average Precision = %.3f' % maprec)
-    log.info('Precision at 10 = %.3f' % prec10)
 
-    return {'MAP': maprec, 'P10': prec10}
+def _load_snapshot(fout, w_length, w_step):
+    """
+    State of the last snapshot saved next to fout (None if missing or
+    trained with another window)
+    """
+    try:
+        st = np.load('%s.state.npz' % fout)
+    except Exception:
+        log.info('No snapshot found, training from scratch')
+        return
+    snapshot = {'pids': st['pids'],
+                'counts': st['counts'],
+                'version': int(st['version'])}
+    if (float(st['window_length']), float(st['window_step'])) != \
+            (float(w_length), float(w_step)):
+        log.warning('The snapshot was trained with window %s, step %s, '
+                    'training from scratch' %
+                    (st['window_length'], st['window_step']))
+        return
+    return snapshot
+
+
+def _save_snapshot(fout, phist, version, w_length, w_step):
+    """
+    Save the number of events of every patient used by the snapshot
+    """
+    phist = ehr_history.as_history(phist)
+    np.savez('%s.state.npz' % fout,
+             pids=phist.pids,
+             counts=np.diff(phist.offsets),
+             version=version,
+             window_length=w_length,
+             window_step=w_step)
 
 
-def _maprec(rank, truth):
+def _events_since(phist, snapshot):
     """
-    Mean average precision
+    Number of events of every patient already used by the snapshot
     """
-    pr = []
-    relev = 0
-    for i, w in enumerate(rank):
-        if w == truth:
-            relev += 1
-            pr.append(relev / float(i + 1))
-    if len(pr) == 0:
-        return 0.0
-    return np.mean(pr)
+    old = dict(zip(snapshot['pids'].tolist(), snapshot['counts'].tolist()))
+    since = np.array([old.get(p, 0) for p in phist.pids.tolist()],
+                     dtype=np.int64)
+    log.info('%d patients with new events' %
+             np.sum(np.diff(phist.offsets) > since))
+    return since
 
 
-def _prec_at_k(rank, truth, k):
+def _evaluation(phemb, evalemb, level='lvl1', knn=50):
     """
-    Precision at k
+    Medical concept embeddings based on Clinical Classification System
+    and hierarchy level equalt to 1
     """
-    relev = 0
-    for r in rank[:k]:
-        if r == truth:
-            relev += 1
-    return relev / float(k)
+    return concept_evaluation.evaluate(
+        phemb, concept_evaluation.from_dict(evalemb), level=level, knn=knn)
 
 
 """
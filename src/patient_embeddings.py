@@ -1,6 +1,11 @@
 from sklearn.decomposition import TruncatedSVD
+from utils import windows
+import scipy.sparse as sp
+import patient_store
+import ehr_history
 import numpy as np
-import bisect
+import array
+import zlib
 import csv
 import os
 
@@ -10,27 +15,56 @@ def patient_embedding(phist,
                       outdir=None,
                       window_length=15,
                       window_step=5,
-                      algo='word2vec'):
+                      algo='word2vec',
+                      dtype=np.float32,
+                      memory_budget=None,
+                      fmt='npy',
+                      delta=False,
+                      drift_tol=0.01):
     """
     Create patient embeddings
 
     @param phist: dictionary with <patient id: [clinical events sorted by date]
+    or the equivalent ehr_history.PatientHistory
     @param embedding: pre-trained medical concept embeddings
+    @param dtype: precision of the weighted concept embeddings (float32 or
+    float16)
+    @param memory_budget: maximum memory (MB) for the patient sentence
+    embeddings; when set, the patients are processed in chunks and the
+    embeddings are written to outdir chunk by chunk (see
+    _stream_patient_embedding)
+    @param fmt: 'npy' to save a binary store (see patient_store) or 'csv'
+    @param delta: update the store saved in outdir recomputing only the
+    patients whose history changed (see _delta_patient_embedding)
+    @param drift_tol: maximum drift of the fitted concept probabilities,
+    principal component and scaling before a delta update falls back to a
+    full refit
     """
 
     if len(phist) == 0 or embedding is None:
         print 'ERROR: data missing -- Interrupting'
         return
 
+    if delta:
+        return _delta_patient_embedding(phist, embedding, outdir,
+                                        window_length, window_step, algo,
+                                        dtype, memory_budget, fmt,
+                                        drift_tol)
+
+    if memory_budget is not None:
+        return _stream_patient_embedding(phist, embedding, outdir,
+                                         window_length, window_step, algo,
+                                         dtype, memory_budget, fmt)
+
     print 'Creating the patient sentences'
     ptn_seq, pw = _create_sentences(
         phist, embedding.wv.vocab, window_length, window_step)
 
-    # index data
-    ivcb = _index_data(embedding.wv.vocab)
+    # index data (aligned with the rows of the embedding matrix)
+    ivcb = _index_data(embedding.wv.index2word)
 
     print 'Weight the embeddings based on phenotype probability'
-    wemb = _weight_embedding(embedding, ivcb, pw)
+    wemb = _weight_embedding(embedding, ivcb, pw, dtype=dtype)
 
     print 'Compute the patient embeddings'
     ptn_emb, pids = _sentence_average(ptn_seq, wemb, ivcb)
@@ -38,78 +72,329 @@ def patient_embedding(phist,
     print 'Denoise the patient embeddings'
     ptn_emb = _denoise_embedding(ptn_emb)
 
-    # save as csv mrn, values
     print 'Save the embeddings'
     _save_patient_embedding(ptn_emb, pids, outdir,
-                            window_length, window_step, algo)
+                            window_length, window_step, algo, fmt)
 
     return ptn_emb
 
 
 # private functions
 
+def _stream_patient_embedding(phist, embedding, outdir, w_length, w_step,
+                              algo, dtype, memory_budget, fmt):
+    """
+    Create the patient embeddings out-of-core. A first pass over the
+    patients computes the concept probabilities; a second pass creates the
+    sentence embeddings chunk by chunk, appends them to disk and accumulates
+    their Gram matrix, whose top eigenvector is the first principal
+    component; two passes over the file on disk then compute the max-abs
+    scaling of the denoised embeddings and write them in the store
+    """
+    if outdir is None:
+        print 'ERROR: outdir missing -- Interrupting'
+        return
+    phist = ehr_history.as_history(phist)
+    vocab = phist.vocab
+    evocab = embedding.wv.vocab
+    known = [w in evocab for w in vocab]
+
+    print 'Compute the concept probabilities'
+    npatient = np.zeros(len(vocab), dtype=np.int64)
+    for p, cid, ages in phist.items():
+        ps = _patient_sentences(cid, ages, known, w_length, w_step)
+        npatient[list(set().union(*ps))] += 1
+    pw, stopw = _concept_probability(vocab, evocab, known, npatient,
+                                     len(phist))
+
+    ivcb = _index_data(embedding.wv.index2word)
+    wemb = _weight_embedding(embedding, ivcb, pw, dtype=dtype)
+
+    # sentences per chunk (embeddings and temporary copies within budget)
+    size = wemb.shape[1]
+    chunk = max(1000, int(memory_budget * 2 ** 20 / (size * 4 * 4)))
+
+    print 'Compute the patient embeddings (%d sentences per chunk)' % chunk
+    fraw = os.path.join(outdir, '%s-patient-embedding.tmp' % algo)
+    gram = np.zeros((size, size), dtype=np.float64)
+    pids = []
+    counts = []
+    nsent = 0
+    with open(fraw, 'wb') as f:
+        ptn_seq = {}
+        nchunk = 0
+        for i, (p, cid, ages) in enumerate(phist.items()):
+            ps = _remove_stopwords(
+                _patient_sentences(cid, ages, known, w_length, w_step),
+                stopw, vocab)
+            if len(ps) > 0:
+                ptn_seq[p] = ps
+                nchunk += len(ps)
+            if nchunk < chunk and i < len(phist) - 1:
+                continue
+            if nchunk == 0:
+                break
+            emb, mrns = _sentence_average(ptn_seq, wemb, ivcb)
+            gram += np.dot(emb.T.astype(np.float64), emb)
+            emb.astype(np.float32).tofile(f)
+            start = np.flatnonzero(np.r_[True, mrns[1:] != mrns[:-1]])
+            pids.append(mrns[start])
+            counts.append(np.diff(np.r_[start, len(mrns)]))
+            nsent += len(mrns)
+            ptn_seq = {}
+            nchunk = 0
+    print 'Created %d clinical sentences' % nsent
+    if nsent == 0:
+        os.remove(fraw)
+        print 'ERROR: no patient sentences -- Interrupting'
+        return
+    pids = np.concatenate(pids)
+    counts = np.concatenate(counts)
+
+    print 'Denoise the patient embeddings'
+    u = _gram_pc(gram)
+    raw = np.memmap(fraw, dtype=np.float32, mode='r', shape=(nsent, size))
+    colmax = np.zeros(size, dtype=np.float32)
+    for b in xrange(0, nsent, chunk):
+        emb = np.asarray(raw[b:b + chunk])
+        emb = emb - emb.dot(u.transpose()) * u
+        colmax = np.maximum(colmax, np.max(np.abs(emb), axis=0))
+
+    print 'Save the embeddings'
+    prefix = patient_store.store_prefix(outdir, algo, size, w_length, w_step)
+    ptn_emb = patient_store.create(prefix, nsent, size)
+    for b in xrange(0, nsent, chunk):
+        emb = np.asarray(raw[b:b + chunk])
+        emb = emb - emb.dot(u.transpose()) * u
+        ptn_emb[b:b + chunk] = emb / colmax
+    ptn_emb.flush()
+    del ptn_emb
+    del raw
+    os.remove(fraw)
+    patient_store.write_index(prefix, pids, _store_meta(
+        algo, w_length, w_step), counts=counts)
+    _save_fit(prefix, phist, known, npatient, stopw, gram, u, colmax)
+
+    store = patient_store.load(prefix)
+    if fmt == 'csv':
+        fout = '%s.csv' % prefix
+        patient_store.export_csv(store, fout)
+        print 'Embeddings saved in: %s' % fout
+    else:
+        print 'Embeddings saved in: %s' % prefix
+
+    return store.vectors
+
+
+def _delta_patient_embedding(phist, embedding, outdir, w_length, w_step,
+                             algo, dtype, memory_budget, fmt, drift_tol):
+    """
+    Update the store saved by a full fit recomputing only the patients
+    whose history changed (new events appended). The concept patient
+    counts and the Gram matrix are updated by removing the contribution
+    of the previous history of these patients; their new sentence
+    embeddings are weighted, denoised and scaled with the fitted concept
+    probabilities, principal component and scaling, and appended to the
+    store. A full refit runs when the history is not append-only, the
+    frequent concepts change or the fitted parameters drift beyond
+    drift_tol. The concept embeddings must be the ones of the full fit
+    """
+    if outdir is None:
+        print 'ERROR: outdir missing -- Interrupting'
+        return
+    if memory_budget is None:
+        memory_budget = 1024
+    size = embedding.wv.vector_size
+    prefix = patient_store.store_prefix(outdir, algo, size, w_length, w_step)
+    fit = patient_store.load_fit(prefix)
+    if fit is None:
+        print 'No fitted store found -- Full fit'
+        return _stream_patient_embedding(phist, embedding, outdir, w_length,
+                                         w_step, algo, dtype, memory_budget,
+                                         fmt)
+
+    def refit(reason):
+        print '%s -- Full refit' % reason
+        return _stream_patient_embedding(phist, embedding, outdir, w_length,
+                                         w_step, algo, dtype, memory_budget,
+                                         fmt)
+
+    phist = ehr_history.as_history(phist)
+    vocab = phist.vocab
+    evocab = embedding.wv.vocab
+    known = [w in evocab for w in vocab]
+
+    # patients with new events
+    nevent = np.diff(phist.offsets)
+    old = dict(zip(fit['pids'].tolist(), fit['nevents'].tolist()))
+    nold = np.array([old.get(p, 0) for p in phist.pids.tolist()],
+                    dtype=np.int64)
+    if np.any(nevent < nold) or \
+            len(old) > len(set(phist.pids.tolist()) & set(old)):
+        return refit('Patients or events removed')
+    if 'checksum' not in fit:
+        return refit('No event checksums in the fit')
+    csum = dict(zip(fit['pids'].tolist(), fit['checksum'].tolist()))
+    csum = np.array([csum.get(p, 0) for p in phist.pids.tolist()],
+                    dtype=np.uint64)
+    if np.any(_history_checksum(phist, nold) != csum):
+        return refit('Events inserted or modified before the new ones')
+    changed = np.flatnonzero(nevent > nold)
+    if len(changed) == 0:
+        print 'The embeddings are up to date'
+        return patient_store.load(prefix).vectors
+    print 'Updating %d patients' % len(changed)
+
+    # update the concept patient counts
+    ifit = dict((w, i) for i, w in enumerate(fit['concepts'].tolist()))
+    jfit = np.array([ifit.get(w, -1) for w in vocab], dtype=np.int64)
+    npatient = np.where(jfit >= 0, fit['npatient'][jfit], 0)
+    ps_old = {}
+    ps_new = {}
+    for i in changed:
+        cid, ages = phist.events(i)
+        p = phist.pids[i]
+        ps_old[p] = _patient_sentences(cid[:nold[i]], ages[:nold[i]],
+                                       known, w_length, w_step)
+        ps_new[p] = _patient_sentences(cid, ages, known, w_length, w_step)
+        npatient[list(set().union(*ps_old[p]))] -= 1
+        npatient[list(set().union(*ps_new[p]))] += 1
+    pw, stopw = _concept_probability(vocab, evocab, known, npatient,
+                                     len(phist))
+
+    # drift of the concept probabilities
+    pfit = np.where(jfit >= 0, fit['pfreq'][jfit], 0)
+    kn = np.flatnonzero(known)
+    pfreq = npatient / float(len(phist))
+    if len(kn) > 0 and np.max(np.abs(pfreq[kn] - pfit[kn])) > drift_tol:
+        return refit('Concept probabilities drifted')
+    sfit = set(np.flatnonzero((jfit >= 0) &
+                              fit['stopw'][np.maximum(jfit, 0)]).tolist())
+    if sfit != stopw:
+        return refit('Frequent concepts changed')
+
+    # sentence embeddings with the fitted weights
+    wfit = dict((w, 0.0) for w in evocab)
+    for c in kn:
+        wfit[vocab[c]] = pfit[c]
+    ivcb = _index_data(embedding.wv.index2word)
+    wemb = _weight_embedding(embedding, ivcb, wfit, dtype=dtype)
+    for ps in [ps_old, ps_new]:
+        for p in ps.keys():
+            ps[p] = _remove_stopwords(ps[p], stopw, vocab)
+            if len(ps[p]) == 0:
+                del ps[p]
+    emb_old, _ = _sentence_average(ps_old, wemb, ivcb)
+    emb, mrns = _sentence_average(ps_new, wemb, ivcb)
+
+    # drift of the principal component and of the scaling
+    gram = fit['gram'] - np.dot(emb_old.T.astype(np.float64), emb_old) + \
+        np.dot(emb.T.astype(np.float64), emb)
+    u = fit['u']
+    if 1 - abs(float(np.dot(_gram_pc(gram)[0], u[0]))) > drift_tol:
+        return refit('Principal component drifted')
+    emb = emb - emb.dot(u.transpose()) * u
+    emb /= fit['colmax']
+    if emb.shape[0] > 0 and np.max(np.abs(emb)) > 1 + drift_tol:
+        return refit('Scaling drifted')
+
+    print 'Save the embeddings'
+    patient_store.append(prefix, emb, mrns, pids=phist.pids[changed].tolist())
+    _save_fit(prefix, phist, known, npatient, stopw, gram, u, fit['colmax'],
+              pfreq=pfit)
+
+    store = patient_store.load(prefix)
+    if fmt == 'csv':
+        fout = '%s.csv' % prefix
+        patient_store.export_csv(store, fout)
+        print 'Embeddings saved in: %s' % fout
+    else:
+        print 'Embeddings saved in: %s' % prefix
+
+    return store.vectors
+
+
+def _save_fit(prefix, phist, known, npatient, stopw, gram, u, colmax,
+              pfreq=None):
+    """
+    Save the state of the fit used by the delta updates: patient counts
+    and fitted probabilities of the concepts, number and checksum of the
+    events of every patient, Gram matrix, principal component and scaling
+
+    @param pfreq: fitted concept probabilities (default: the current ones)
+    """
+    kn = np.flatnonzero(known)
+    if pfreq is None:
+        pfreq = npatient / float(len(phist))
+    stop = np.zeros(len(known), dtype=bool)
+    stop[list(stopw)] = True
+    patient_store.save_fit(prefix,
+                           concepts=np.array([phist.vocab[c] for c in kn]),
+                           npatient=npatient[kn],
+                           pfreq=pfreq[kn],
+                           stopw=stop[kn],
+                           pids=phist.pids,
+                           nevents=np.diff(phist.offsets),
+                           checksum=_history_checksum(
+                               phist, np.diff(phist.offsets)),
+                           gram=gram,
+                           u=u,
+                           colmax=colmax)
+
+
+def _history_checksum(phist, nevents, chunk=10000000):
+    """
+    Checksum of the first nevents events (concepts and ages) of every
+    patient, used to detect the histories that are not append-only. The
+    events are read in chunks of about chunk events
+    """
+    chash = np.array([zlib.crc32(w.encode('utf-8') if isinstance(w, unicode)
+                                 else w) & 0xffffffff for w in phist.vocab],
+                     dtype=np.uint64)
+    offsets = np.asarray(phist.offsets)
+    nevents = np.asarray(nevents, dtype=np.int64)
+    out = np.zeros(len(phist), dtype=np.uint64)
+    b = 0
+    while b < len(phist):
+        e = np.searchsorted(offsets, offsets[b] + chunk, 'right') - 1
+        e = min(max(e, b + 1), len(phist))
+        lo = offsets[b]
+        hi = offsets[e]
+        ag = np.asarray(phist.ages[lo:hi], dtype=np.float64)
+        ev = chash[np.asarray(phist.concepts[lo:hi])] * \
+            np.uint64(0x9E3779B97F4A7C15) + ag.view(np.uint64)
+        csum = np.zeros(hi - lo + 1, dtype=np.uint64)
+        np.cumsum(ev, out=csum[1:])
+        start = offsets[b:e] - lo
+        out[b:e] = csum[start + nevents[b:e]] - csum[start]
+        b = e
+    return out
+
+
 def _create_sentences(phist, evocab, w_length, w_step):
     """
     Create patient longitudinal sentences. We used age_in_days as temporal
     index (replace with dates or other surrogates for time information)
     """
-    ptn_seq = {}
-    wprob = {w: set() for w in evocab}
-    for p, ev in phist.items():
-        ptn_seq[p] = []
-        concepts = [el[0] for el in ev]
-        age_in_days = [el[1] for el in ev]
-        last_ag = []
-
-        # create the sentences moving the time window
-        begin = age_in_days[0]
-        while begin <= age_in_days[-1]:
-            # find the range in age_in_days
-            end = begin + w_length
-            il = bisect.bisect_left(age_in_days, begin)
-            ir = bisect.bisect_left(age_in_days, end)
-
-            # get data
-            ag = age_in_days[il:ir]
-            co = concepts[il:ir]
-
-            # move window
-            begin += w_step
-
-            # check interval
-            if len(ag) == 0:
-                continue
-
-            if ag == last_ag:
-                continue
+    phist = ehr_history.as_history(phist)
+    vocab = phist.vocab
 
-            # update last
-            last_ag = ag
+    # concepts of the history that have an embedding
+    known = [w in evocab for w in vocab]
+    npatient = np.zeros(len(vocab), dtype=np.int64)
 
-            # create sentence
-            s = set()
-            for w in co:
-                if w not in evocab:
-                    continue
-                s.add(w)
-                wprob[w].add(p)
-            if len(s) > 0:
-                ptn_seq[p].append(s)
+    ptn_seq = {}
+    for p, cid, ages in phist.items():
+        ptn_seq[p] = _patient_sentences(cid, ages, known, w_length, w_step)
+        npatient[list(set().union(*ptn_seq[p]))] += 1
 
-    n = len(ptn_seq)
-    for w, c in wprob.items():
-        wprob[w] = len(c) / float(n)
+    wprob, stopw = _concept_probability(vocab, evocab, known, npatient,
+                                        len(ptn_seq))
 
     # remove frequent concepts
-    stopw = set(w for w in wprob if wprob[w] > 0.5)
     ptn_sent = {}
     for p in ptn_seq:
-        ps = []
-        for el in ptn_seq[p]:
-            s = el - stopw
-            if len(s) == 0:
-                continue
-            ps.append(s)
+        ps = _remove_stopwords(ptn_seq[p], stopw, vocab)
         if len(ps) > 0:
             ptn_sent[p] = ps
 
@@ -119,37 +404,130 @@ def _create_sentences(phist, evocab, w_length, w_step):
     return (ptn_sent, wprob)
 
 
-def _weight_embedding(embs, ivcb, pw):
+def _patient_sentences(cid, ages, known, w_length, w_step):
+    """
+    Create the sentences of one patient (sets of concept IDs with an
+    embedding)
+    """
+    sentences = []
+    concepts = cid.tolist()
+    age_in_days = ages.tolist()
+    last_ag = []
+
+    # create the sentences moving the time window
+    for il, ir in windows.sliding_windows(age_in_days, w_length, w_step):
+        # get data
+        ag = age_in_days[il:ir]
+        co = concepts[il:ir]
+
+        # check interval
+        if ag == last_ag:
+            continue
+
+        # update last
+        last_ag = ag
+
+        # create sentence
+        s = set(c for c in co if known[c])
+        if len(s) > 0:
+            sentences.append(s)
+    return sentences
+
+
+def _concept_probability(vocab, evocab, known, npatient, n):
+    """
+    Fraction of patients with every concept and frequent concepts (in
+    more than half of the patients)
+    """
+    pfreq = npatient / float(n)
+    wprob = dict((w, 0.0) for w in evocab)
+    for c in np.flatnonzero(known):
+        wprob[vocab[c]] = pfreq[c]
+    stopw = set(np.flatnonzero(np.array(known) & (pfreq > 0.5)).tolist())
+    return (wprob, stopw)
+
+
+def _remove_stopwords(sentences, stopw, vocab):
+    """
+    Remove the frequent concepts and return the sentences as concept sets
+    """
+    ps = []
+    for el in sentences:
+        s = el - stopw
+        if len(s) == 0:
+            continue
+        ps.append(set(vocab[c] for c in s))
+    return ps
+
+
+def _weight_embedding(embs, ivcb, pw, dtype=np.float32):
     """
     Weight the medical conceot embeddings to differentiate not impactful
-    concepts
+    concepts. The whole embedding matrix is standardized row-wise and
+    scaled by the a / (a + p) weights at once
+
+    @param ivcb: concept index aligned with the rows of embs.wv.vectors
+    @param dtype: dtype of the weighted embeddings (computed in at least
+    float32 precision)
     """
     a = 1
-    apw = {}
-    for w, p in pw.items():
-        apw[w] = a / (a + p)
-    wemb = np.zeros([len(ivcb), embs.vector_size])
-    for w in ivcb:
-        ew = (embs.wv[w] - embs.wv[w].mean()) / embs.wv[w].std()
-        wemb[ivcb[w], :] = ew * apw[w]
-    return wemb
+    words = sorted(ivcb, key=ivcb.get)
+    apw = np.array([a / (a + pw[w]) for w in words])
+
+    cdtype = np.promote_types(dtype, np.float32)
+    emb = np.asarray(embs.wv.vectors[[embs.wv.vocab[w].index
+                                      for w in words]], dtype=cdtype)
+    wemb = emb - emb.mean(axis=1)[:, np.newaxis]
+    wemb /= emb.std(axis=1)[:, np.newaxis]
+    wemb *= apw.astype(cdtype)[:, np.newaxis]
+    return wemb.astype(dtype, copy=False)
 
 
-def _sentence_average(ptn_seq, wemb, ivcb):
+def _sentence_average(ptn_seq, wemb, ivcb, chunk_size=1000000):
     """
-    Create the patient sentence embeddings
+    Create the patient sentence embeddings. Every chunk of sentences is
+    encoded as a sentence x concept CSR matrix with 1 / sentence length
+    weights, so that its product with the concept embeddings gives the
+    sentence averages
     """
-    ptn_emb = []
-    mrns = []
-    for p in ptn_seq:
+    pids = list(ptn_seq)
+    nsent = np.array([len(ptn_seq[p]) for p in pids], dtype=np.int64)
+    ptn_emb = np.empty((nsent.sum(), wemb.shape[1]),
+                       dtype=np.promote_types(wemb.dtype, np.float32))
+    mrns = np.repeat(np.array(pids), nsent)
+
+    row = 0
+    indices = array.array('i')
+    slen = array.array('i')
+    for p in pids:
         for s in ptn_seq[p]:
-            wi = [ivcb[w] for w in s]
-            ptn_emb.append(np.average(wemb[wi, :], axis=0))
-            mrns.append(p)
-    ptn_emb = np.array(ptn_emb)
+            indices.extend(ivcb[w] for w in s)
+            slen.append(len(s))
+        if len(slen) >= chunk_size:
+            row = _average_chunk(ptn_emb, row, wemb, indices, slen)
+            indices = array.array('i')
+            slen = array.array('i')
+    _average_chunk(ptn_emb, row, wemb, indices, slen)
+
     return (ptn_emb, mrns)
 
 
+def _average_chunk(ptn_emb, row, wemb, indices, slen):
+    """
+    Average a chunk of sentences into ptn_emb starting from row
+    """
+    if len(slen) == 0:
+        return row
+    slen = np.frombuffer(slen, dtype=np.int32)
+    indptr = np.zeros(len(slen) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(slen)
+    data = np.repeat(1. / slen, slen).astype(ptn_emb.dtype)
+    smtx = sp.csr_matrix((data, np.frombuffer(indices, dtype=np.int32),
+                          indptr), shape=(len(slen), wemb.shape[0]))
+    ptn_emb[row:row + len(slen)] = smtx.dot(wemb)
+    return row + len(slen)
+
+
 def _denoise_embedding(v):
     """
     Denoise embeddings by subtracting the projections of the average vectors
@@ -169,14 +547,33 @@ def _compute_pc(x):
     return svd.components_
 
 
+def _gram_pc(gram):
+    """
+    First principal component (first right singular vector, as computed
+    by _compute_pc) from the Gram matrix x.T x
+    """
+    _, vec = np.linalg.eigh(gram)
+    return vec[:, -1][np.newaxis, :].astype(np.float32)
+
+
 def _index_data(dt):
     return {el: i for i, el in enumerate(dt)}
 
 
 def _save_patient_embedding(emb, pids, outdir,
-                            w_length, w_step, algo):
+                            w_length, w_step, algo, fmt='npy'):
     if outdir is None:
         return
+
+    # save embedding as binary store (float16)
+    prefix = patient_store.store_prefix(outdir, algo, emb.shape[1],
+                                        w_length, w_step)
+    if fmt == 'npy':
+        patient_store.save(prefix, emb, pids,
+                           _store_meta(algo, w_length, w_step))
+        print 'Embeddings saved in: %s' % prefix
+        return
+
     emb = emb.astype(np.float16)
 
     # save embedding as csv
@@ -184,9 +581,7 @@ def _save_patient_embedding(emb, pids, outdir,
     for i in xrange(emb.shape[0]):
         out.append([pids[i]] + list(emb[i, :]))
 
-    fout = os.path.join(outdir,
-                        '%s-patient-embedding-%d-%d-%d.csv' %
-                        (algo, emb.shape[1], w_length, w_step))
+    fout = '%s.csv' % prefix
 
     with open(fout, 'w') as f:
         wr = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
@@ -195,6 +590,10 @@ def _save_patient_embedding(emb, pids, outdir,
     print 'Embeddings saved in: %s' % fout
 
 
+def _store_meta(algo, w_length, w_step):
+    return {'algo': algo, 'window_length': w_length, 'window_step': w_step}
+
+
 """
 Main script
 """
@@ -0,0 +1,305 @@
+import numpy as np
+import json
+import csv
+import os
+
+"""
+Binary store of patient embeddings. A store saved with prefix P holds:
+    P.vectors.npy  sentence embeddings, one row per patient sentence with
+                   the sentences of every patient in contiguous rows
+    P.pids.npy     patient IDs
+    P.index.npy    int64 [start, end) rows of every patient
+    P.json         metadata (algo, window, dtype, shape, n_sentences rows
+                   in the index and n_rows rows in P.vectors.npy)
+    P.fit.npz      fitted state used by the delta updates (optional)
+All arrays are memory-mapped on load. Delta updates append the new rows of
+the updated patients at the end of P.vectors.npy; their previous rows are
+left unused until the store is compacted (see append and compact)
+"""
+
+
+class PatientStore(object):
+    """
+    Patient embeddings loaded from a binary store
+    """
+
+    def __init__(self, vectors, pids, index, meta):
+        self.vectors = vectors
+        self.pids = pids
+        self.index = index
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.pids)
+
+    @property
+    def pidx(self):
+        """
+        Patient index <MRN: rows of the patient sentences> (as expected by
+        phenotype_evaluation.eval_embedding)
+        """
+        return dict((p, xrange(b, e))
+                    for p, (b, e) in zip(self.pids.tolist(),
+                                         self.index.tolist()))
+
+    def patient(self, i):
+        """
+        Sentence embeddings of the i-th patient (view, no copy)
+        """
+        b, e = self.index[i]
+        return self.vectors[b:e]
+
+
+def store_prefix(outdir, algo, size, w_length, w_step):
+    return os.path.join(outdir, '%s-patient-embedding-%d-%d-%d' %
+                        (algo, size, w_length, w_step))
+
+
+def create(prefix, nrows, size, dtype=np.float16):
+    """
+    Create the (writable, memory-mapped) vector file of a store
+    """
+    return np.lib.format.open_memmap('%s.vectors.npy' % prefix, mode='w+',
+                                     dtype=dtype, shape=(nrows, size))
+
+
+def write_index(prefix, mrns, meta=None, counts=None):
+    """
+    Save the patient index of a store from the patient of every row
+
+    @param mrns: patient ID of every row (rows of a patient contiguous)
+    @param meta: dictionary of metadata (algo, window_length, ...)
+    @param counts: number of rows of every patient, in which case mrns
+    lists every patient once (in row order)
+    """
+    mrns = np.asarray(mrns)
+    if counts is None:
+        n = len(mrns)
+        start = np.flatnonzero(np.r_[True, mrns[1:] != mrns[:-1]])[:n]
+        pids = mrns[start]
+        end = np.r_[start[1:], n]
+    else:
+        pids = mrns
+        end = np.cumsum(np.asarray(counts, dtype=np.int64))
+        start = end - counts
+    index = np.empty((len(start), 2), dtype=np.int64)
+    index[:, 0] = start
+    index[:, 1] = end
+    np.save('%s.pids.npy' % prefix, pids)
+    np.save('%s.index.npy' % prefix, index)
+
+    vec = np.load('%s.vectors.npy' % prefix, mmap_mode='r')
+    info = dict(meta or {})
+    info.update({'dtype': str(vec.dtype),
+                 'n_sentences': int(np.sum(index[:, 1] - index[:, 0])),
+                 'n_rows': vec.shape[0],
+                 'size': vec.shape[1],
+                 'n_patients': len(start)})
+    with open('%s.json' % prefix, 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+
+def save(prefix, emb, mrns, meta=None, dtype=np.float16, chunk=1000000):
+    """
+    Save the patient embeddings (rows of a patient contiguous)
+    """
+    vec = create(prefix, emb.shape[0], emb.shape[1], dtype)
+    for b in xrange(0, emb.shape[0], chunk):
+        vec[b:b + chunk] = emb[b:b + chunk]
+    vec.flush()
+    del vec
+    write_index(prefix, mrns, meta)
+
+
+def load(prefix, mmap=True):
+    """
+    Load a store (memory-mapping the arrays read-only when mmap is True)
+    """
+    mode = 'r' if mmap else None
+    vectors = np.load('%s.vectors.npy' % prefix, mmap_mode=mode)
+    pids = np.load('%s.pids.npy' % prefix)
+    index = np.load('%s.index.npy' % prefix, mmap_mode=mode)
+    with open('%s.json' % prefix) as f:
+        meta = json.load(f)
+    return PatientStore(vectors, pids, index, meta)
+
+
+def append(prefix, emb, mrns, pids=None, meta=None, chunk=1000000,
+           max_unused=0.25):
+    """
+    Append the sentence embeddings of some patients (rows of a patient
+    contiguous) and point the index of these patients to the new rows
+
+    @param pids: patients updated (default: the patients in mrns); the
+    ones without new rows are left without sentences
+    @param max_unused: fraction of unused rows above which the store is
+    compacted (None to never compact)
+    """
+    fname = '%s.vectors.npy' % prefix
+    vec = np.load(fname, mmap_mode='r')
+    nold = vec.shape[0]
+    dtype = vec.dtype
+    del vec
+
+    # append the rows (rewriting the file when the header cannot grow)
+    if _resize_header(fname, nold + emb.shape[0], dry_run=True):
+        with open(fname, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            for b in xrange(0, emb.shape[0], chunk):
+                np.asarray(emb[b:b + chunk], dtype=dtype).tofile(f)
+        _resize_header(fname, nold + emb.shape[0])
+    else:
+        old = np.load(fname, mmap_mode='r')
+        vec = np.lib.format.open_memmap(
+            '%s.tmp' % fname, mode='w+', dtype=dtype,
+            shape=(nold + emb.shape[0], old.shape[1]))
+        for b in xrange(0, nold, chunk):
+            vec[b:min(b + chunk, nold)] = old[b:b + chunk]
+        vec[nold:] = emb
+        vec.flush()
+        del vec
+        del old
+        os.rename('%s.tmp' % fname, fname)
+
+    # rows of the updated patients
+    mrns = np.asarray(mrns)
+    n = len(mrns)
+    start = np.flatnonzero(np.r_[True, mrns[1:] != mrns[:-1]])[:n]
+    rows = dict(zip(mrns[start].tolist(),
+                    zip((start + nold).tolist(),
+                        (np.r_[start[1:], n] + nold).tolist())))
+    if pids is None:
+        pids = rows.keys()
+
+    # patient index (the vectors are not read)
+    oldpids = np.load('%s.pids.npy' % prefix)
+    with open('%s.json' % prefix) as f:
+        meta_old = json.load(f)
+    ipid = dict((p, i) for i, p in enumerate(oldpids.tolist()))
+    index = np.load('%s.index.npy' % prefix).tolist()
+    allpids = oldpids.tolist()
+    for p in pids:
+        r = rows.get(p, (0, 0))
+        if p in ipid:
+            index[ipid[p]] = r
+        else:
+            ipid[p] = len(allpids)
+            allpids.append(p)
+            index.append(r)
+    index = np.array(index, dtype=np.int64).reshape(-1, 2)
+    np.save('%s.pids.npy' % prefix, np.array(allpids))
+    np.save('%s.index.npy' % prefix, index)
+
+    info = dict(meta_old)
+    info.update(meta or {})
+    info.update({'n_sentences': int(np.sum(index[:, 1] - index[:, 0])),
+                 'n_rows': nold + emb.shape[0],
+                 'n_patients': len(allpids)})
+    with open('%s.json' % prefix, 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+    # drop the unused rows
+    unused = info['n_rows'] - info['n_sentences']
+    if max_unused is not None and unused > max_unused * info['n_rows']:
+        compact(prefix, chunk)
+
+
+def compact(prefix, chunk=1000000):
+    """
+    Rewrite the vectors of a store keeping only the rows of the patient
+    index, in index order (the rows left unused by append are dropped)
+    """
+    store = load(prefix)
+    index = np.array(store.index)
+    vec = store.vectors
+    size = index[:, 1] - index[:, 0]
+    start = np.zeros(len(index), dtype=np.int64)
+    start[1:] = np.cumsum(size)[:-1]
+    nrows = int(size.sum())
+
+    # copy the runs of patients with consecutive rows
+    fname = '%s.vectors.npy' % prefix
+    out = np.lib.format.open_memmap('%s.tmp' % fname, mode='w+',
+                                    dtype=vec.dtype,
+                                    shape=(nrows, vec.shape[1]))
+    run = np.flatnonzero(np.r_[True, index[1:, 0] != index[:-1, 1]])
+    run = run[:len(index)]
+    for r, s in zip(run.tolist(), np.r_[run[1:], len(index)].tolist()):
+        b = index[r, 0]
+        e = index[s - 1, 1]
+        for k in xrange(b, e, chunk):
+            o = start[r] + k - b
+            out[o:o + min(chunk, e - k)] = vec[k:min(k + chunk, e)]
+    out.flush()
+    del out
+    del vec
+    del store.vectors
+    os.rename('%s.tmp' % fname, fname)
+
+    index[:, 0] = start
+    index[:, 1] = start + size
+    np.save('%s.index.npy' % prefix, index)
+    info = dict(store.meta)
+    info.update({'n_sentences': nrows, 'n_rows': nrows})
+    with open('%s.json' % prefix, 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+
+def save_fit(prefix, **arrays):
+    """
+    Save the fitted state of the embeddings (see patient_embeddings)
+    """
+    np.savez('%s.fit.npz' % prefix, **arrays)
+
+
+def load_fit(prefix):
+    """
+    Load the fitted state of the embeddings (None if missing)
+    """
+    try:
+        with np.load('%s.fit.npz' % prefix) as fit:
+            return dict(fit.items())
+    except Exception:
+        return
+
+
+def export_csv(store, fout):
+    """
+    Write the embeddings as csv (PID, F0, F1, ...)
+    """
+    with open(fout, 'w') as f:
+        wr = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        wr.writerow(['PID'] + ['F%d' % i
+                               for i in xrange(store.vectors.shape[1])])
+        for p, (b, e) in zip(store.pids.tolist(), store.index.tolist()):
+            emb = np.asarray(store.vectors[b:e])
+            for i in xrange(emb.shape[0]):
+                wr.writerow([p] + list(emb[i, :]))
+
+
+# private functions
+
+def _resize_header(fname, nrows, dry_run=False):
+    """
+    Set the number of rows in the header of a .npy file in place
+
+    @return: False if the new header does not fit in the space of the old
+    one
+    """
+    with open(fname, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            room = f.tell() - 10
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            room = f.tell() - 12
+        header = "{'descr': %r, 'fortran_order': %r, 'shape': %r, }" % \
+            (np.lib.format.dtype_to_descr(dtype), fortran,
+             (nrows,) + tuple(shape[1:]))
+        if len(header) + 1 > room:
+            return False
+        if not dry_run:
+            f.seek(f.tell() - room)
+            f.write(header.ljust(room - 1) + '\n')
+    return True
@@ -1,6 +1,6 @@
-from scipy.spatial.distance import cdist
 from utils import metrics as me
 import numpy as np
+import time
 import os
 import warnings
 
@@ -16,14 +16,27 @@ def eval_embedding(eptn,
                    pidx,
                    evcb,
                    gt_pheno,
-                   outdir=None):
+                   outdir=None,
+                   chunk_size=100000,
+                   batch=False,
+                   pq=None,
+                   rerank=1000):
     """
     Evaluate pre-loaded phe2vec representantions for disease cohort retrieval
 
     @param eptn: patient embeddings
     @param pidx: patient index (<MRN: dataset ID>)
-    @param evcb: medical concept embedding model
+    (both available from patient_store.load as store.vectors / store.pidx)
+    @param evcb: medical concept embedding model (or the approximate
+    nearest neighbour index from ann_index.load for faster query expansion)
     @param gt_pheno: ground truth based on PheKB {<disease: [MRNs]}
+    @param chunk_size: number of patient sentences scored at once
+    @param batch: score all the phenotypes in a single pass over the
+    patient embeddings
+    @param pq: product-quantized patient embeddings (quantization.load);
+    the phenotypes are scored on the codes in a single pass and the top
+    rerank patients of every phenotype are re-ranked with eptn
+    @return: {metric: [value of every phenotype]}
     """
 
     # create output directory
@@ -31,40 +44,202 @@ def eval_embedding(eptn,
         if not os.path.isdir(outdir):
             os.makedirs(outdir)
 
+    # patient sentence norms and layout (shared by all the phenotypes)
+    if pq is not None:
+        norms = pq.norms
+    else:
+        norms = _sentence_norms(eptn, chunk_size)
+    layout = _index_patients(pidx)
+
     # evaluation
     results = {m: [] for m in metrics}
+    if batch or pq is not None:
+        _eval_batch(eptn, norms, layout, evcb, gt_pheno, results, chunk_size,
+                    pq, rerank)
+        _print_average(results)
+        return results
+
     for ph in sorted(gt_pheno):
         print 'Processing:', ph
         print '--- Query Seed:', ', '.join(gt_pheno[ph]['seed'])
 
         # create query
-        qv, ql, qexp = _define_query_vector(
+        query = _define_query_vector(
             evcb, gt_pheno[ph]['seed'], expand=True)
-        if qv is None:
+        if query is None:
             continue
+        qv, ql, qexp = query
 
-        # compute distance between queries and patient sentences
-        edist = cdist(qv, eptn, metric='cosine')
-
-        # aggregate the query distance values
-        sdist = _aggregate_dist(edist)
+        # mean distance between the queries and every patient sentence
+        sdist = _aggregate_dist(qv, eptn, norms, chunk_size)
 
         # aggregate patient sentence distances
-        pdist, imrn = _aggregate_sentences(sdist, pidx)
-
-        # ranking
-        ptn_rnk = [(imrn[r], pdist[r]) for r in np.argsort(pdist)]
+        pdist, imrn = _aggregate_sentences(sdist, layout)
 
         # evaluation
-        _evaluation(ptn_rnk, ph, gt_pheno[ph], results)
+        _evaluation(pdist, imrn, ph, gt_pheno[ph], results)
 
     _print_average(results)
 
-    return
+    return results
+
+
+def quantization_report(eptn, pidx, evcb, gt_pheno, pq, rerank=1000,
+                        outfile=None, chunk_size=100000):
+    """
+    Compare the retrieval metrics of the quantized scoring (with exact
+    re-ranking) against the exact one
+
+    @param outfile: optional csv file where the report is written
+    """
+    start = time.time()
+    exact = eval_embedding(eptn, pidx, evcb, gt_pheno,
+                           chunk_size=chunk_size, batch=True)
+    exact_sec = time.time() - start
+    start = time.time()
+    approx = eval_embedding(eptn, pidx, evcb, gt_pheno,
+                            chunk_size=chunk_size, pq=pq, rerank=rerank)
+    approx_sec = time.time() - start
+
+    report = []
+    for m in metrics:
+        e = np.mean(exact[m]) if len(exact[m]) > 0 else np.nan
+        a = np.mean(approx[m]) if len(approx[m]) > 0 else np.nan
+        report.append((m, e, a, a - e))
+    ebytes = eptn.shape[1] * eptn.dtype.itemsize
+    qbytes = pq.codes.shape[1] + pq.norms.dtype.itemsize
+
+    print '\nQuantization report (rerank = %d)' % rerank
+    print '--- Bytes per sentence: %d (exact) / %d (quantized)' % (
+        ebytes, qbytes)
+    print '--- Seconds: %.1f (exact) / %.1f (quantized)' % (
+        exact_sec, approx_sec)
+    for m, e, a, d in report:
+        print '--- %s = %.3f / %.3f (%+.3f)' % (m, e, a, d)
+
+    if outfile is not None:
+        with open(outfile, 'w') as f:
+            f.write('METRIC,EXACT,QUANTIZED,DELTA\n')
+            for r in report:
+                f.write('%s,%.3f,%.3f,%.3f\n' % r)
+            f.write('BYTES/SENTENCE,%d,%d,%d\n' % (ebytes, qbytes,
+                                                   qbytes - ebytes))
+            f.write('SECONDS,%.1f,%.1f,%.1f\n' % (exact_sec, approx_sec,
+                                                  approx_sec - exact_sec))
+
+    return report
 
 
 # private functions
 
+def _eval_batch(eptn, norms, layout, evcb, gt_pheno, results, chunk_size,
+                pq=None, rerank=1000):
+    """
+    Evaluate all the phenotypes streaming the patient embeddings (or their
+    quantized codes) once
+    """
+    # create the queries
+    qmean = []
+    phs = []
+    for ph in sorted(gt_pheno):
+        query = _define_query_vector(evcb, gt_pheno[ph]['seed'], expand=True)
+        if query is None:
+            continue
+        qmean.append(_mean_query(query[0]))
+        phs.append(ph)
+    if len(phs) == 0:
+        return
+
+    # patient distances for every phenotype
+    print 'Scoring %d phenotypes' % len(phs)
+    pdist, imrn = _score_patients(np.array(qmean), eptn if pq is None else pq,
+                                  norms, layout, chunk_size)
+
+    # exact distances of the top candidates
+    if pq is not None:
+        for k in xrange(len(phs)):
+            _rerank(pdist[:, k], qmean[k], eptn, norms, layout, rerank)
+
+    for k, ph in enumerate(phs):
+        print 'Processing:', ph
+        print '--- Query Seed:', ', '.join(gt_pheno[ph]['seed'])
+
+        # evaluation
+        _evaluation(pdist[:, k], imrn, ph, gt_pheno[ph], results)
+
+
+def _score_patients(qmean, eptn, norms, layout, chunk_size=100000):
+    """
+    Patient distances (min over the patient sentences of the mean cosine
+    distance to the queries) for several phenotypes at once. The sentences
+    are streamed once in patient order; every chunk is scored against all
+    the phenotypes with one matrix product and the per-patient minima are
+    accumulated across chunks
+
+    @param qmean: mean unit query vector of every phenotype
+    @param eptn: sentence embeddings or their quantized codes
+    (quantization.PQCodes, scored with lookup tables)
+    @return: (patients x phenotypes distances, MRN of every patient)
+    """
+    mrns, order, bounds = layout
+    qmean = np.asarray(qmean, dtype=np.float64)
+    pdist = np.empty((len(mrns), len(qmean)), dtype=np.float64)
+    pdist.fill(np.inf)
+    lut = None
+    if hasattr(eptn, 'lookup_tables'):
+        lut = eptn.lookup_tables(qmean)
+    for b in xrange(0, bounds[-1], chunk_size):
+        e = min(b + chunk_size, bounds[-1])
+        rows = slice(b, e) if order is None else order[b:e]
+        if lut is None:
+            emb = np.asarray(eptn[rows], dtype=np.float64)
+            dot = emb.dot(qmean.T)
+        else:
+            dot = eptn.inner(rows, lut)
+        dist = 1 - dot / norms[rows][:, np.newaxis]
+
+        # patients with sentences in the chunk
+        k0 = np.searchsorted(bounds, b, side='right') - 1
+        k1 = np.searchsorted(bounds, e, side='left')
+        seg = np.maximum(bounds[k0:k1], b) - b
+        red = np.minimum.reduceat(dist, seg, axis=0)
+        pdist[k0:k1] = np.minimum(pdist[k0:k1], red)
+    return (pdist, mrns)
+
+
+def _rerank(pdist, qmean, eptn, norms, layout, rerank):
+    """
+    Replace the approximate distances of the rerank closest patients with
+    the exact ones (in place)
+    """
+    mrns, order, bounds = layout
+    rerank = min(rerank, len(pdist))
+    if rerank == 0:
+        return
+    if rerank < len(pdist):
+        top = np.sort(np.argpartition(pdist, rerank - 1)[:rerank])
+    else:
+        top = np.arange(len(pdist))
+
+    # sentence rows of the candidates (segments in layout order)
+    size = bounds[top + 1] - bounds[top]
+    start = np.r_[0, np.cumsum(size)[:-1]]
+    pos = np.arange(size.sum()) - np.repeat(start - bounds[top], size)
+    rows = pos if order is None else order[pos]
+
+    emb = np.asarray(eptn[rows], dtype=np.float64)
+    dist = 1 - emb.dot(np.asarray(qmean, dtype=np.float64)) / norms[rows]
+    pdist[top] = np.minimum.reduceat(dist, start)
+
+
+def _mean_query(qv):
+    """
+    Mean of the unit query vectors
+    """
+    qv = np.asarray(qv, dtype=np.float64)
+    return np.mean(qv / np.linalg.norm(qv, axis=1)[:, np.newaxis], axis=0)
+
+
 def _define_query_vector(epheno, query_seed, expand=True):
     """
     Define the disease phenotype using distance analysis in the embedded space
@@ -93,37 +268,112 @@ def _define_query_vector(epheno, query_seed, expand=True):
     return (np.array(eq), ql, qexp)
 
 
-def _aggregate_dist(edist):
+def _aggregate_dist(qv, eptn, norms, chunk_size=100000):
     """
-    Aggregate using mean the PSE - phenotype distances
+    Aggregate using mean the PSE - phenotype cosine distances. The mean
+    cosine distance of a sentence e to the queries q_i is
+    1 - mean_i(q_i / |q_i|) . e / |e|, computed on chunks of sentences
+    without materializing the query x sentence distance matrix
     """
-    dist = np.mean(edist, axis=0)
+    qmean = _mean_query(qv)
+    dist = np.empty(eptn.shape[0], dtype=np.float64)
+    for b in xrange(0, eptn.shape[0], chunk_size):
+        e = np.asarray(eptn[b:b + chunk_size], dtype=np.float64)
+        dist[b:b + chunk_size] = 1 - e.dot(qmean) / norms[b:b + chunk_size]
     return dist
 
 
-def _aggregate_sentences(sent_dist, pidx):
+def _sentence_norms(eptn, chunk_size=100000):
     """
-    Aggregate usin min the PSE - phenotype element distances
+    L2 norm of every patient sentence embedding
     """
-    pdist = np.empty(shape=len(pidx))
-    imrn = {}
-    for i, p in enumerate(pidx):
-        imrn[i] = p
-        iptn = pidx[p]
-        pdist[i] = np.min(sent_dist[list(iptn)])
-    return (pdist, imrn)
+    norms = np.empty(eptn.shape[0], dtype=np.float64)
+    for b in xrange(0, eptn.shape[0], chunk_size):
+        e = np.asarray(eptn[b:b + chunk_size], dtype=np.float64)
+        norms[b:b + chunk_size] = np.sqrt(np.einsum('ij,ij->i', e, e))
+    return norms
 
 
-def _evaluation(ptn_rnk, ph, gt, results):
+def _aggregate_sentences(sent_dist, layout):
     """
-    Evaluation
+    Aggregate usin min the PSE - phenotype element distances (one
+    segmented reduction over the sentences grouped by patient)
+
+    @param layout: patient sentence layout from _index_patients
+    """
+    mrns, order, bounds = layout
+    if order is not None:
+        sent_dist = sent_dist[order]
+    pdist = np.minimum.reduceat(sent_dist[:bounds[-1]], bounds[:-1])
+    return (pdist, mrns)
+
+
+def _index_patients(pidx):
+    """
+    Group the sentences of every patient into contiguous segments
+
+    @return: (MRN of every patient, sentence order or None when the
+    sentences of every patient are already contiguous and sorted, bounds
+    of the patient segments in that order)
+    """
+    # segments of the patients (ranges are not expanded)
+    mrns = []
+    first = []
+    size = []
+    rows = {}
+    for p in pidx:
+        iptn = pidx[p]
+        if len(iptn) == 0:
+            continue
+        if not isinstance(iptn, (xrange, list, tuple, np.ndarray)):
+            # other iterables of rows (e.g., sets)
+            iptn = np.sort(np.fromiter(iptn, dtype=np.int64))
+        mrns.append(p)
+        size.append(len(iptn))
+        if isinstance(iptn, xrange) or \
+                (iptn[-1] - iptn[0] == len(iptn) - 1 and
+                 np.all(np.diff(iptn) == 1)):
+            first.append(iptn[0])
+        else:
+            first.append(-1)
+            rows[len(mrns) - 1] = np.asarray(iptn, dtype=np.int64)
+    first = np.array(first, dtype=np.int64)
+    size = np.array(size, dtype=np.int64)
+
+    # sort the patients by first sentence
+    iord = np.argsort(first, kind='mergesort')
+    mrns = np.array(mrns)[iord]
+    first = first[iord]
+    size = size[iord]
+    bounds = np.r_[0, np.cumsum(size)].astype(np.int64)
+
+    # contiguous layout: the segments tile the sentence rows
+    if len(rows) == 0 and np.array_equal(first, bounds[:-1]):
+        return (mrns, None, bounds)
+
+    order = np.empty(bounds[-1], dtype=np.int64)
+    for k, i in enumerate(iord):
+        if i in rows:
+            order[bounds[k]:bounds[k + 1]] = rows[i]
+        else:
+            order[bounds[k]:bounds[k + 1]] = np.arange(
+                first[k], first[k] + size[k])
+    return (mrns, order, bounds)
+
+
+def _evaluation(pdist, mrns, ph, gt, results, n=10):
+    """
+    Evaluation (the patients are ranked by increasing distance; only the
+    rank positions of the ground truth cases are computed)
+
+    @param pdist: distance of every patient
+    @param mrns: MRN of every patient
     """
     print '--- No. of cases: %d' % (len(gt))
 
     # organize data
-    iimrn = {ptn_rnk[i][0]: i for i in xrange(len(ptn_rnk))}
-    pprob = np.array([p[1] for p in ptn_rnk])
-    pprob = np.exp(-pprob).round(5)
+    ipos = np.flatnonzero(np.in1d(mrns, np.asarray(list(gt))))
+    pprob = np.exp(-pdist).round(5)
 
     # define threshold (this should be defined via cross-validation)
     th = 0.5
@@ -132,9 +382,17 @@ def _evaluation(ptn_rnk, ph, gt, results):
     bprob = np.zeros(len(pprob))
     bprob[pprob > th] = 1
     truth = np.zeros(len(pprob))
-    ipos = [iimrn[p] for p in gt]
     truth[ipos] = 1
 
+    # relevance of the top of the ranking (up to the last case)
+    rpos = _positive_ranks(pdist, ipos)
+    if len(rpos) > 0:
+        rlen = min(len(pdist), max(n, len(gt), rpos[-1] + 1))
+    else:
+        rlen = len(pdist)
+    rel = np.zeros(rlen, dtype=bool)
+    rel[rpos] = True
+
     # annotation
     results['Precision'].append(me.precision(bprob, truth))
     print '--- Precision = %.3f' % results['Precision'][-1]
@@ -144,12 +402,11 @@ def _evaluation(ptn_rnk, ph, gt, results):
     print '--- F-score = %.3f' % results['F-score'][-1]
 
     # ranking
-    mrns = [r[0] for r in ptn_rnk]
-    results['Prec@10'].append(me.precision_at_n(mrns, gt, 10))
+    results['Prec@10'].append(me.precision_at_n_rel(rel, n))
     print '--- Prec@10 = %.3f' % results['Prec@10'][-1]
-    results['Prec@r'].append(me.r_precision(mrns, gt))
+    results['Prec@r'].append(me.r_precision_rel(rel, len(gt)))
     print '--- Prec@r = %.3f' % results['Prec@r'][-1]
-    results['MAP'].append(me.maprec(mrns, gt))
+    results['MAP'].append(me.maprec_rel(rel, len(gt)))
     print '--- MAP = %.3f' % results['MAP'][-1]
     try:
         results['AUC-ROC'].append(me.auc_roc(pprob, truth))
@@ -162,6 +419,32 @@ def _evaluation(ptn_rnk, ph, gt, results):
     return
 
 
+def _positive_ranks(pdist, ipos):
+    """
+    Sorted rank positions (0-based, by increasing distance, ties broken by
+    patient order) of the patients ipos, counting the patients ranked
+    before each of them in O(N log P) instead of sorting all the patients
+    """
+    ipos = np.asarray(ipos, dtype=np.int64)
+    if len(ipos) == 0:
+        return ipos
+    order = np.lexsort((ipos, pdist[ipos]))
+    pd = pdist[ipos][order]
+
+    # number of cases ranked before every patient
+    below = np.searchsorted(pd, pdist, side='right')
+    lo = np.searchsorted(pd, pdist, side='left')
+    tie = np.flatnonzero(below > lo)
+    if len(tie) > 0:
+        # patients at the same distance of a case: compare the positions
+        n = len(pdist) + 1
+        key = np.searchsorted(pd, pd, side='left') * n + ipos[order]
+        below[tie] = np.searchsorted(key, lo[tie] * n + tie, side='right')
+
+    # patients ranked before every case
+    return np.cumsum(np.bincount(below, minlength=len(pd) + 1))[:len(pd)]
+
+
 def _print_average(results):
     print '\nAverage'
     print '--- Precision = %.3f' % np.mean(results['Precision'])
@@ -0,0 +1,200 @@
+from utils import similarity as si
+import numpy as np
+import logging
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Product quantization of the patient embedding store. Every sentence
+embedding is split into m sub-vectors, each replaced by the index of its
+closest centroid (k <= 256, one byte) in a codebook trained with k-means
+on a sample of the store. A quantized store with prefix P (the one of the
+patient_store) adds:
+    P.pq-codebooks.npy  float32 m x k x (size / m) centroids
+    P.pq-codes.npy      uint8 codes, one row per sentence
+    P.pq-norms.npy      float32 exact L2 norm of every sentence
+    P.pq.json           version of P.vectors.npy that was quantized (rows,
+                        file size and modification time)
+Inner products with a query are computed from the codes with one lookup
+table per sub-vector (see PQCodes.lookup_tables)
+"""
+
+
+class PQCodes(object):
+    """
+    Product-quantized sentence embeddings
+    """
+
+    def __init__(self, codebooks, codes, norms):
+        self.codebooks = codebooks
+        self.codes = codes
+        self.norms = norms
+
+    @property
+    def shape(self):
+        return (self.codes.shape[0],
+                self.codebooks.shape[0] * self.codebooks.shape[2])
+
+    def lookup_tables(self, qv):
+        """
+        Inner products of the query sub-vectors with every centroid
+
+        @param qv: queries (one per row)
+        @return: queries x m x k tables
+        """
+        m, k, ds = self.codebooks.shape
+        qv = np.asarray(qv, dtype=np.float32).reshape(-1, m, ds)
+        return np.einsum('qmd,mkd->qmk', qv, self.codebooks)
+
+    def inner(self, rows, lut):
+        """
+        Approximate inner products of the sentences rows with the queries
+        of the lookup tables
+
+        @return: sentences x queries inner products
+        """
+        codes = np.asarray(self.codes[rows])
+        dot = np.zeros((len(codes), lut.shape[0]), dtype=np.float64)
+        for j in xrange(codes.shape[1]):
+            dot += lut[:, j, codes[:, j]].T
+        return dot
+
+
+def train(vectors, m=None, k=256, sample=100000, niter=10, seed=0):
+    """
+    Train the codebooks on a sample of the sentence embeddings
+
+    @param m: number of sub-vectors (default: sub-vectors of 8 dimensions);
+    it must divide the embedding size
+    @param k: centroids per sub-vector (at most 256)
+    @param sample: number of sentences used for training
+    """
+    n, size = vectors.shape
+    m = _subvectors(size, m)
+    rs = np.random.RandomState(seed)
+    if sample < n:
+        rows = np.sort(rs.choice(n, sample, replace=False))
+    else:
+        rows = np.arange(n)
+    k = min(k, 256, len(rows))
+    x = np.asarray(vectors[rows], dtype=np.float32)
+    ds = size // m
+
+    log.info('Training %d x %d centroids on %d sentences' % (m, k, len(x)))
+    codebooks = np.zeros((m, k, ds), dtype=np.float32)
+    for j in xrange(m):
+        cent, _ = si.kmeans(x[:, j * ds:(j + 1) * ds], k, niter=niter,
+                            seed=seed + j)
+        codebooks[j, :len(cent)] = cent
+    return codebooks
+
+
+def encode(vectors, codebooks, out, norms, chunk=100000):
+    """
+    Encode the sentence embeddings into out (and their norms into norms)
+    """
+    m, _, ds = codebooks.shape
+    for b in xrange(0, vectors.shape[0], chunk):
+        x = np.asarray(vectors[b:b + chunk], dtype=np.float32)
+        norms[b:b + chunk] = np.sqrt(np.einsum('ij,ij->i', x, x))
+        for j in xrange(m):
+            out[b:b + chunk, j] = si.assign_centroids(
+                x[:, j * ds:(j + 1) * ds], codebooks[j])
+
+
+def quantize_store(prefix, m=None, k=256, sample=100000, niter=10,
+                   chunk=100000):
+    """
+    Quantize the vectors of a patient_store and save the codes next to it
+    """
+    vectors = np.load('%s.vectors.npy' % prefix, mmap_mode='r')
+    start = time.time()
+    codebooks = train(vectors, m=m, k=k, sample=sample, niter=niter)
+    np.save('%s.pq-codebooks.npy' % prefix, codebooks)
+    codes = np.lib.format.open_memmap(
+        '%s.pq-codes.npy' % prefix, mode='w+', dtype=np.uint8,
+        shape=(vectors.shape[0], codebooks.shape[0]))
+    norms = np.lib.format.open_memmap(
+        '%s.pq-norms.npy' % prefix, mode='w+', dtype=np.float32,
+        shape=(vectors.shape[0],))
+    encode(vectors, codebooks, codes, norms, chunk)
+    codes.flush()
+    norms.flush()
+    with open('%s.pq.json' % prefix, 'w') as f:
+        json.dump(_store_version(prefix), f, indent=2, sort_keys=True)
+    log.info('Quantized %d sentences into %d bytes each (%.1fx smaller, '
+             '%.1fs)' % (vectors.shape[0], codes.shape[1],
+                         vectors.shape[1] * vectors.dtype.itemsize /
+                         float(codes.shape[1]), time.time() - start))
+    del codes
+    del norms
+    return load(prefix)
+
+
+def load(prefix, mmap=True):
+    """
+    Load the quantized store (memory-mapping codes and norms read-only
+    when mmap is True); None if it is missing or the vectors of the store
+    changed since they were quantized (e.g., by patient_store.append or
+    patient_store.compact)
+    """
+    mode = 'r' if mmap else None
+    try:
+        codebooks = np.load('%s.pq-codebooks.npy' % prefix)
+        codes = np.load('%s.pq-codes.npy' % prefix, mmap_mode=mode)
+        norms = np.load('%s.pq-norms.npy' % prefix, mmap_mode=mode)
+        with open('%s.pq.json' % prefix) as f:
+            version = json.load(f)
+    except Exception, e:
+        log.error('Impossible to load the quantized store - %s ' % str(e))
+        return
+    if version != _store_version(prefix) or \
+            codes.shape[0] != version['n_rows']:
+        log.error('The store changed since it was quantized, quantize the '
+                  'store again')
+        return
+    return PQCodes(codebooks, codes, norms)
+
+
+# private functions
+
+def _store_version(prefix):
+    """
+    Rows, size and modification time of the vectors of a store
+    """
+    fname = '%s.vectors.npy' % prefix
+    st = os.stat(fname)
+    return {'n_rows': int(np.load(fname, mmap_mode='r').shape[0]),
+            'size': int(st.st_size),
+            'mtime': repr(st.st_mtime)}
+
+
+def _subvectors(size, m):
+    if m is None:
+        m = max(1, size // 8)
+        while size % m != 0:
+            m -= 1
+    if size % m != 0:
+        raise ValueError('%d sub-vectors do not divide the embedding size '
+                         '%d' % (m, size))
+    return m
+
+
+"""
+Main script
+"""
+
+if __name__ == '__main__':
+    print ''
+
+    # patient_store prefix (see patient_embeddings)
+    prefix = None
+
+    quantize_store(prefix)
+
+    print '\nTask completed\n'
@@ -0,0 +1,245 @@
+import medical_concept_embeddings as mce
+import multiprocessing as mp
+import word2vec
+import fasttext
+import gloveloc
+import ehr_corpus
+import ehr_history
+import numpy as np
+import itertools
+import hashlib
+import logging
+import time
+import csv
+import os
+
+log = logging.getLogger(__name__)
+if not len(log.handlers):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+"""
+Hyperparameter sweep of the medical concept embeddings. Configurations
+share the work of the earlier stages: the sentences are created once per
+(window_length, window_step) and saved as on-disk corpora, the GloVe
+co-occurrences are built once per corpus, and only the training jobs run
+per configuration, on a process pool with a fixed number of cores each.
+The cached stages are keyed on a fingerprint of the patient history, so
+sweeps on other or updated histories in the same outdir do not reuse them
+"""
+
+_params = ['algo', 'window_length', 'window_step', 'emb_size']
+
+_models = {'word2vec': word2vec, 'fasttext': fasttext, 'glove': gloveloc}
+
+
+def run_sweep(phist,
+              grid,
+              outdir,
+              evalfile,
+              knn=50,
+              min_count=3,
+              workers=20,
+              job_workers=4,
+              save_models=False):
+    """
+    Train and evaluate the embeddings of every configuration of the grid
+
+    @param phist: dictionary with <patient id: [clinical events sorted by
+    date] or the equivalent ehr_history.PatientHistory
+    @param grid: {parameter: [values]} for algo, window_length,
+    window_step and emb_size (missing parameters take the ehr_embedding
+    defaults)
+    @param evalfile: ontology file used for evaluation (see
+    concept_evaluation.load_ontology)
+    @param workers: total number of cores of the sweep
+    @param job_workers: number of cores of every training job
+    @return: list of results {parameters, MAP, P10, N, seconds}
+    """
+    try:
+        os.makedirs(os.path.join(outdir, 'cache'))
+    except Exception:
+        pass
+
+    configs = expand_grid(grid)
+    log.info('Sweep of %d configurations' % len(configs))
+    phist = ehr_history.as_history(phist)
+    fprint = _fingerprint(phist)
+    log.info('Patient history fingerprint: %s' % fprint)
+
+    # sentences (once per window)
+    corpora = {}
+    for c in configs:
+        wkey = (c['window_length'], c['window_step'])
+        if wkey not in corpora:
+            corpora[wkey] = _cached_corpus(phist, outdir, fprint, *wkey)
+
+    # GloVe co-occurrences (once per corpus)
+    cooccur = {}
+    for c in configs:
+        wkey = (c['window_length'], c['window_step'])
+        if c['algo'] == 'glove' and wkey not in cooccur:
+            cooccur[wkey] = _cached_cooccurrence(corpora[wkey], min_count)
+
+    # training and evaluation jobs
+    jobs = []
+    for c in configs:
+        wkey = (c['window_length'], c['window_step'])
+        jobs.append({'config': c,
+                     'corpus': corpora[wkey],
+                     'cooccur': cooccur.get(wkey),
+                     'min_count': min_count,
+                     'workers': job_workers,
+                     'evalfile': evalfile,
+                     'knn': knn,
+                     'outdir': outdir if save_models else None})
+    nproc = max(1, min(len(jobs), workers // max(1, job_workers)))
+    log.info('Running %d jobs on %d processes (%d cores each)' %
+             (len(jobs), nproc, job_workers))
+    pool = mp.Pool(processes=nproc)
+    try:
+        results = pool.map(_train_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    save_results(results, os.path.join(outdir, 'sweep-results.csv'))
+    return results
+
+
+def expand_grid(grid):
+    """
+    List of configurations {parameter: value} of a parameter grid
+    """
+    default = {'algo': ['word2vec'], 'window_length': [15],
+               'window_step': [5], 'emb_size': [200]}
+    values = [grid.get(p, default[p]) for p in _params]
+    return [dict(zip(_params, v)) for v in itertools.product(*values)]
+
+
+def save_results(results, fout):
+    """
+    Write the results table (one row per configuration)
+    """
+    with open(fout, 'w') as f:
+        wr = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        wr.writerow([p.upper() for p in _params] +
+                    ['MAP', 'P10', 'N', 'SECONDS'])
+        for r in results:
+            wr.writerow([r[p] for p in _params] +
+                        [r['MAP'], r['P10'], r['N'], r['seconds']])
+    log.info('Saved the results of %d configurations in %s' %
+             (len(results), fout))
+
+
+# private functions
+
+def _fingerprint(phist, chunk=1000000):
+    """
+    Hash of the patients, events and vocabulary of a history (key of the
+    cached stages)
+    """
+    h = hashlib.sha1()
+    h.update('%d:%d:' % (len(phist.pids), len(phist.concepts)))
+    for a in [phist.pids, phist.offsets, phist.concepts, phist.ages]:
+        if a.dtype.kind == 'O':
+            h.update(repr(a.tolist()))
+            continue
+        h.update(str(a.dtype))
+        for b in xrange(0, len(a), chunk):
+            h.update(np.ascontiguousarray(a[b:b + chunk]).tostring())
+    for w in phist.vocab:
+        if isinstance(w, unicode):
+            w = w.encode('utf-8')
+        h.update('%s\n' % w)
+    return h.hexdigest()[:16]
+
+
+def _cached_corpus(phist, outdir, fprint, w_length, w_step):
+    """
+    On-disk corpus of the sentences of a window (reused when it exists for
+    the same history fingerprint)
+    """
+    prefix = os.path.join(outdir, 'cache', 'sentences-%s-%s-%s' %
+                          (fprint, w_length, w_step))
+    if os.path.isfile('%s.vocab' % prefix):
+        log.info('Reusing the sentences in %s' % prefix)
+        return prefix
+    log.info('Creating sentences (window %s, step %s)' % (w_length, w_step))
+    ehr_corpus.write_corpus(
+        mce._iter_sentences(phist, w_length, w_step), prefix)
+    return prefix
+
+
+def _cached_cooccurrence(corpus, min_count):
+    """
+    GloVe co-occurrences of a corpus (reused when they exist)
+    """
+    prefix = '%s.cooccur-%d' % (corpus, min_count)
+    if os.path.isfile('%s.vocab' % prefix):
+        log.info('Reusing the co-occurrences in %s' % prefix)
+        return prefix
+    words, tt_mtx = gloveloc.cooccurrence(
+        ehr_corpus.load_corpus(corpus), min_count=min_count)
+    gloveloc.save_cooccurrence(words, tt_mtx, prefix)
+    return prefix
+
+
+def _train_job(job):
+    """
+    Train and evaluate one configuration (runs in a worker process)
+    """
+    c = job['config']
+    res = dict(c)
+    res.update({'MAP': '', 'P10': '', 'N': '', 'seconds': ''})
+    start = time.time()
+    try:
+        model = _models[c['algo']]
+        if c['algo'] == 'glove':
+            emb = model.train(None,
+                              size=c['emb_size'],
+                              min_count=job['min_count'],
+                              workers=job['workers'],
+                              backend='native',
+                              cooccur=gloveloc.load_cooccurrence(
+                                  job['cooccur']))
+        else:
+            emb = model.train(ehr_corpus.load_corpus(job['corpus']),
+                              size=c['emb_size'],
+                              min_count=job['min_count'],
+                              workers=job['workers'])
+        res['seconds'] = round(time.time() - start, 1)
+
+        if job['outdir'] is not None:
+            model.save(emb, os.path.join(
+                job['outdir'], '%s-pheno-embedding-%d-%s-%s.emb' %
+                (c['algo'], c['emb_size'], c['window_length'],
+                 c['window_step'])))
+
+        ev = mce.ehr_evaluation(phemb=emb, evalfile=job['evalfile'],
+                                knn=job['knn'])
+        res.update(ev)
+    except Exception, e:
+        log.error('Configuration %s failed - %s' % (str(c), str(e)))
+    return res
+
+
+"""
+Main script
+"""
+
+if __name__ == '__main__':
+    print ''
+
+    # load data (patient history and CCS file)
+    phist = None
+    evalfile = None
+    outdir = None
+
+    grid = {'algo': ['word2vec', 'fasttext', 'glove'],
+            'window_length': [15, 30],
+            'window_step': [5],
+            'emb_size': [100, 200]}
+
+    run_sweep(phist, grid, outdir, evalfile, workers=20, job_workers=4)
+
+    print '\nTask completed\n'
@@ -2,6 +2,11 @@ __all__ = ['precision_at_n',
            'r_precision',
            'maprec',
            'mrr',
+           'relevance',
+           'precision_at_n_rel',
+           'r_precision_rel',
+           'maprec_rel',
+           'mrr_rel',
            'aroc',
            'precisison',
            'recall',
@@ -1,4 +1,5 @@
 import sklearn.metrics as me
+import numpy as np
 
 
 # Rank Evaluation
@@ -61,6 +62,76 @@ def mrr(rank, truth):
     return round(mrr, 3)
 
 
+# Vectorized Rank Evaluation (boolean relevance of the ranked items, one
+# row per ranking to evaluate a batch of rankings at once)
+
+
+def relevance(rank, truth):
+    """
+    Boolean relevance of the ranked items
+    """
+    return np.in1d(np.asarray(rank), np.asarray(list(truth)))
+
+
+def precision_at_n_rel(rel, n=10):
+    """
+    Precision at N
+
+    :param n: cutoff (int or one per ranking)
+    """
+    rel, single = _as_batch(rel)
+    return _round(_precision(rel, _per_row(n, rel)), single)
+
+
+def r_precision_rel(rel, n_truth=None):
+    """
+    R-Precision
+
+    :param n_truth: number of relevant items (default: relevant items in
+    the ranking)
+    """
+    rel, single = _as_batch(rel)
+    if n_truth is None:
+        n_truth = rel.sum(axis=1)
+    n = np.maximum(_per_row(n_truth, rel), 1)
+    return _round(_precision(rel, n), single)
+
+
+def maprec_rel(rel, n_truth=None, k=None):
+    """
+    Mean Average Precision (average precision of the first n_truth
+    relevant items)
+
+    :param k: limit to the "k" top ranked documents
+    """
+    rel, single = _as_batch(rel)
+    rel = rel[:, :k]
+    if n_truth is None:
+        n_truth = rel.sum(axis=1)
+    n_truth = _per_row(n_truth, rel)
+    csum = np.cumsum(rel, axis=1, dtype=np.int64)
+    hit = rel & (csum <= n_truth[:, np.newaxis])
+    prec = np.where(hit, csum / np.arange(1., rel.shape[1] + 1), 0.)
+    nhit = hit.sum(axis=1)
+
+    # running sum in rank order (as maprec, so the rounding agrees)
+    total = np.zeros(len(rel))
+    if rel.shape[1] > 0:
+        total = np.cumsum(prec, axis=1)[:, -1]
+    m = total / np.maximum(nhit, 1)
+    return _round(m, single)
+
+
+def mrr_rel(rel):
+    """
+    Mean Reciprocal Rank
+    """
+    rel, single = _as_batch(rel)
+    rk = np.where(rel.any(axis=1), rel.argmax(axis=1) + 1, rel.shape[1])
+    m = 1 / rk.astype(np.float64)
+    return _round(m, single)
+
+
 # Information Retrival Classic Evaluation
 
 
@@ -112,3 +183,28 @@ def auc_pr(scores, truth):
     auc_pr = me.average_precision_score(truth, scores)
     return round(auc_pr, 3)
 
+
+# private functions
+
+def _as_batch(rel):
+    rel = np.asarray(rel, dtype=bool)
+    return (np.atleast_2d(rel), rel.ndim == 1)
+
+
+def _per_row(v, rel):
+    return np.zeros(len(rel), dtype=np.int64) + np.asarray(v, dtype=np.int64)
+
+
+def _precision(rel, n):
+    """
+    Fraction of relevant items in the top n of every ranking
+    """
+    m = min(n.max(), rel.shape[1])
+    csum = np.zeros((len(rel), m + 1), dtype=np.int64)
+    np.cumsum(rel[:, :m], axis=1, out=csum[:, 1:])
+    return csum[np.arange(len(rel)), np.minimum(n, m)] / n.astype(np.float64)
+
+
+def _round(m, single):
+    m = [round(float(x), 3) for x in m]
+    return m[0] if single else np.array(m)
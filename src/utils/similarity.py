@@ -0,0 +1,105 @@
+import numpy as np
+
+"""
+Blocked cosine similarity over medical concept embeddings
+"""
+
+
+def unit_vectors(kv):
+    """
+    Return the L2-normalized embedding matrix (one row per concept)
+
+    @param kv: gensim KeyedVectors (the normalized matrix is computed once
+    and cached by gensim in kv.vectors_norm)
+    """
+    kv.init_sims()
+    return kv.vectors_norm
+
+
+def blocked_most_similar(unorm, qidx, topn=100, block_size=1024):
+    """
+    Find the topn most similar concepts for every query row, scoring
+    blocks of queries against the whole vocabulary with one matrix product.
+    The query concept is excluded from its own neighbours, as gensim
+    most_similar does
+
+    @param unorm: L2-normalized embedding matrix
+    @param qidx: row indices of the query concepts
+    @param block_size: number of queries scored per matrix product, which
+    bounds the peak memory to block_size x vocabulary similarities
+    @return: generator of (query indices, neighbour indices, similarities)
+    for every block, neighbours sorted by decreasing similarity
+    """
+    qidx = np.asarray(qidx, dtype=np.int64)
+    nvcb = unorm.shape[0]
+    topn = min(topn, nvcb - 1)
+    if topn < 1:
+        return
+    for b in xrange(0, len(qidx), block_size):
+        bidx = qidx[b:b + block_size]
+        rows = np.arange(len(bidx))
+
+        # re-normalize the queries as gensim does for the mean vector
+        qv = unorm[bidx]
+        qv = qv / np.linalg.norm(qv, axis=1)[:, np.newaxis]
+        sim = np.dot(qv, unorm.T)
+        sim[rows, bidx] = -np.inf
+
+        # top-n selection without sorting the whole vocabulary
+        top = np.argpartition(-sim, topn - 1, axis=1)[:, :topn]
+        tsim = sim[rows[:, np.newaxis], top]
+        order = np.argsort(-tsim, axis=1, kind='mergesort')
+        top = top[rows[:, np.newaxis], order]
+        tsim = tsim[rows[:, np.newaxis], order]
+        yield (bidx, top, tsim)
+
+
+def kmeans(x, k, niter=10, spherical=False, block_size=4096, seed=0):
+    """
+    Lloyd's k-means on the rows of x (spherical k-means on unit vectors
+    when spherical=True, i.e. clusters by cosine similarity)
+
+    @param k: number of centroids
+    @return: (centroids, assignment of every row of x)
+    """
+    rs = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, x.shape[0])
+    cent = x[rs.choice(x.shape[0], k, replace=False)].copy()
+    assign = None
+    for _ in xrange(niter):
+        assign = assign_centroids(x, cent, spherical, block_size)
+        cnt = np.bincount(assign, minlength=len(cent))
+
+        # sum the members of every cluster
+        order = np.argsort(assign, kind='mergesort')
+        sa = assign[order]
+        starts = np.flatnonzero(np.r_[True, sa[1:] != sa[:-1]])
+        csum = np.zeros(cent.shape, dtype=np.float64)
+        csum[sa[starts]] = np.add.reduceat(
+            x[order].astype(np.float64), starts, axis=0)
+        empty = cnt == 0
+        cent = (csum[~empty] / cnt[~empty][:, np.newaxis]).astype(np.float32)
+
+        # re-seed empty clusters with random points
+        if empty.any():
+            reseed = x[rs.choice(x.shape[0], empty.sum(), replace=False)]
+            cent = np.vstack([cent, reseed])
+        if spherical:
+            cent /= np.maximum(
+                np.linalg.norm(cent, axis=1), 1e-12)[:, np.newaxis]
+    assign = assign_centroids(x, cent, spherical, block_size)
+    return (cent, assign)
+
+
+def assign_centroids(x, cent, spherical=False, block_size=4096):
+    """
+    Assign every row of x to its closest centroid
+    """
+    assign = np.empty(x.shape[0], dtype=np.int64)
+    half = 0 if spherical else 0.5 * (cent ** 2).sum(axis=1)
+    for b in xrange(0, x.shape[0], block_size):
+        # argmin ||x - c||^2 = argmax (x.c - ||c||^2 / 2)
+        sc = np.dot(x[b:b + block_size], cent.T) - half
+        assign[b:b + block_size] = np.argmax(sc, axis=1)
+    return assign
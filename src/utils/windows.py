@@ -0,0 +1,78 @@
+import math
+
+"""
+Sliding time windows over sorted patient events
+"""
+
+
+def sliding_windows(ages, w_length, w_step):
+    """
+    Generate the index ranges (il, ir) of the non-empty time windows
+    [begin, begin + w_length) with begin moving by w_step from the first
+    event to the last one. Equivalent to bisecting ages at every step, but
+    it scans the events with two pointers and jumps over the empty spans
+    between events (the jump is computed directly when the first age and
+    w_step are integral; with fractional values begin is stepped as a
+    running sum, so that it takes exactly the same values)
+
+    @param ages: sorted event times (e.g., age_in_days)
+    """
+    n = len(ages)
+    if n == 0:
+        return
+    first = ages[0]
+    last = ages[-1]
+    exact = _integral(first) and _integral(w_step)
+    il = 0
+    ir = 0
+    k = 0
+    begin = first
+    while begin <= last:
+        end = begin + w_length
+
+        # first event in the window (exists since begin <= last)
+        while ages[il] < begin:
+            il += 1
+
+        # empty window: move to the first one that reaches the next event
+        if ages[il] >= end:
+            if exact:
+                k = _next_step(ages[il], first, w_length, w_step, k)
+                begin = first + k * w_step
+            else:
+                begin += w_step
+                while begin + w_length <= ages[il]:
+                    begin += w_step
+            continue
+
+        # last event in the window
+        if ir < il:
+            ir = il
+        while ir < n and ages[ir] < end:
+            ir += 1
+
+        yield (il, ir)
+        k += 1
+        if exact:
+            begin = first + k * w_step
+        else:
+            begin += w_step
+
+
+# private functions
+
+def _integral(v):
+    return float(v).is_integer()
+
+
+def _next_step(age, first, w_length, w_step, k):
+    """
+    First step after k whose window [begin, begin + w_length) reaches age
+    """
+    j = max(k + 1, int(math.floor(
+        (age - w_length - first) / float(w_step))) + 1)
+    while j > k + 1 and first + (j - 1) * w_step + w_length > age:
+        j -= 1
+    while first + j * w_step + w_length <= age:
+        j += 1
+    return j